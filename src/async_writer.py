@@ -0,0 +1,58 @@
+import asyncio
+import math
+
+from sync import _invoke, _next_call
+
+
+class AsyncSyncWriter(object):
+    """
+    asyncio counterpart of SyncWriter.
+
+    Waits on an asyncio.Event instead of a thread and runs `function` and
+    `poll` in `executor`, which should have a single worker so all
+    Voicemeeter calls happen on the same thread. notify() has to be called
+    from the event loop's thread.
+    """
+
+    def __init__(self, executor, function, debounce: float = 0.005, poll=None, poll_interval: float = 0.1, due=None):
+        self.executor = executor
+        self.function = function
+        self.debounce = debounce
+        self.poll = poll
+        self.poll_interval = poll_interval
+        self.due = due
+        self._event = asyncio.Event()
+        self._task = None
+
+    def notify(self):
+        """Schedules a call of the sync function."""
+        self._event.set()
+
+    def start(self):
+        """Starts the writer as a task on the running event loop."""
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_poll = loop.time() + self.poll_interval if self.poll is not None else math.inf
+        next_call = math.inf
+        while True:
+            deadline = min(next_poll, next_call)
+            timeout = None if deadline == math.inf else max(0, deadline - loop.time())
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            if self._event.is_set() or loop.time() >= next_call:
+                if self._event.is_set() and self.debounce > 0:
+                    await asyncio.sleep(self.debounce)
+                self._event.clear()
+                await loop.run_in_executor(self.executor, _invoke, self.function)
+                next_call = _next_call(self.due)
+            if self.poll is not None and loop.time() >= next_poll:
+                await loop.run_in_executor(self.executor, _invoke, self.poll)
+                next_poll = loop.time() + self.poll_interval
@@ -1,45 +1,28 @@
-import voicemeeter
+from __future__ import annotations
+import time
+STARTUP = time.perf_counter()
+
 import json
 import os
+import socket
 import sys
-import time
 import traceback
-import ctypes
-import zeroconf
-from pythonosc import dispatcher, osc_server, udp_client
-from tinyoscquery.queryservice import OSCQueryService
+from contextlib import contextmanager
+from threading import Thread
+from typing import TYPE_CHECKING
 from tinyoscquery.utility import get_open_tcp_port, get_open_udp_port, check_if_tcp_port_open, check_if_udp_port_open
-from tinyoscquery.query import OSCQueryBrowser, OSCQueryClient
-from psutil import process_iter
-from threading import Thread, Timer
 import logging
-import openvr
-
 
-class RepeatedTimer(object):
-	def __init__(self, interval: float, function, *args, **kwargs):
-		self._timer: Timer = None
-		self.interval = interval
-		self.function = function
-		self.args = args
-		self.kwargs = kwargs
-		self.is_running: bool = False
-		self.start()
-
-	def _run(self):
-		self.is_running = False
-		self.start()
-		self.function(*self.args, **self.kwargs)
-
-	def start(self):
-		if not self.is_running:
-			self._timer = Timer(self.interval, self._run)
-			self._timer.start()
-			self.is_running = True
-
-	def stop(self):
-		self._timer.cancel()
-		self.is_running = False
+# Everything else is imported by the startup phase that needs it, so the OSC port is bound first.
+if TYPE_CHECKING:
+    from concurrent.futures import ThreadPoolExecutor
+    from osc import BundleSender, ExactDispatcher
+    from process import ProcessWatcher
+    from pythonosc import osc_server
+    from sync import Binding, ParamSync, SyncWriter
+    from tinyoscquery.query import OSCQueryBrowser, OSCQueryClient
+    from tinyoscquery.queryservice import OSCQueryService
+    import voicemeeter
 
 
 def get_absolute_path(relative_path, script_path=__file__) -> str:
@@ -48,31 +31,39 @@ def get_absolute_path(relative_path, script_path=__file__) -> str:
     return os.path.join(base_path, relative_path)
 
 
-def get_float_from_voicemeeter_gain(g):
-    """Maps a gain value between min_gain and max_gain to a float from 0.0 to 1.0."""
-    return (g - MIN_GAIN) / (MAX_GAIN - MIN_GAIN)
+def show_error(text, title):
+    """Shows an error message box on Windows."""
+    if os.name == "nt":
+        import ctypes
+        ctypes.windll.user32.MessageBoxW(0, text, title, 0)
 
 
-def get_voicemeeter_gain_from_float(f):
-    """Maps a float from 0.0 to 1.0 to a gain value between min_gain and max_gain."""
-    return f * (MAX_GAIN - MIN_GAIN) + MIN_GAIN
+@contextmanager
+def startup_phase(name):
+    """Records how long a startup phase took, see log_startup_report()."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_phases.append((name, start, time.perf_counter()))
 
 
-def is_vrchat_running() -> bool:
-    """Checks if VRChat is running."""
-    _proc_name = "VRChat.exe" if os.name == 'nt' else "VRChat"
-    return _proc_name in (p.name() for p in process_iter())
+def log_startup_report():
+    """Logs the duration of every startup phase and the time since launch at its end."""
+    logging.debug("startup: self [ms] | cumulative [ms] | phase")
+    for name, start, end in startup_phases:
+        logging.debug(f"startup: {(end - start) * 1e3:9.1f} | {(end - STARTUP) * 1e3:15.1f} | {name}")
 
 
 def wait_get_oscquery_client():
-    service_info = None
-    logging.info("Waiting for VRChat to be discovered.")
-    while service_info is None:
+    global browser
+    if browser is None:
+        from tinyoscquery.query import OSCQueryBrowser
         browser = OSCQueryBrowser()
-        time.sleep(2) # Wait for discovery
-        service_info = browser.find_service_by_name("VRChat")
+    logging.info("Waiting for VRChat to be discovered.")
+    service_info = browser.wait_for_service("VRChat")
     logging.info("VRChat discovered!")
-    client = OSCQueryClient(service_info)
+    client = browser.get_client(service_info)
     logging.info("Waiting for VRChat to be ready.")
     while client.query_node(AVATAR_CHANGE_PARAMETER) is None:
         time.sleep(2)
@@ -80,40 +71,49 @@ def wait_get_oscquery_client():
     return client
 
 
-def set_gain_variable_in(addr, value):
-    global gains_in, changed
-    strip = int(addr.split('_')[-1])
-    gain = get_voicemeeter_gain_from_float(float(value))
-    gains_in[strip] = round(gain, 1)
-    changed = True
+def make_binding(entry) -> Binding:
+    """Creates a Binding from an entry of the bindings table in config.json."""
+    key, prop = entry['target'].split('.')
+    address = entry['address']
+    if not address.startswith('/'):
+        address = PARAMETER_PREFIX + address
+    return Binding(address, key.upper(), vmr.get_element(key), prop, entry.get('range'), entry.get('step'),
+                   entry.get('max_write_rate', MAX_WRITE_RATE), entry.get('ramp_time', RAMP_TIME))
 
 
-def set_gain_variable_out(addr, value):
-    global gains_out, changed
-    strip = int(addr.split('_')[-1])
-    gain = get_voicemeeter_gain_from_float(float(value))
-    gains_out[strip] = round(gain, 1)
-    changed = True
+def make_binding_handler(slot):
+    """Creates an OSC handler that stores a value in its mailbox slot."""
+    mailbox = param_sync.mailbox
+    def handler(value):
+        mailbox.put(slot, value)
+        update_writer.notify()
+    return handler
 
 
-def set_gains():
-    global changed
-    global vmr, gains_in
+def make_profile_handler(index):
+    """Creates an OSC handler that loads a configured profile."""
+    def handler(value):
+        call_voicemeeter(set_profile, index, value)
+    return handler
+
+
+def call_voicemeeter(function, *args):
+    """Calls a function that talks to Voicemeeter, on the writer thread or the DLL thread in asyncio mode."""
+    if dll_executor is not None:
+        dll_executor.submit(function, *args)
+    else:
+        update_writer.submit(function, *args)
+
+
+def get_osc_value(slot):
+    """Returns the shadowed value of a slot as sent to VRChat."""
+    return bindings[slot].to_osc(param_sync.shadow(slot))
 
-    if not changed:
-        return
 
-    for strip in STRIPS_IN:
-        if round(vmr.inputs[strip].gain, 1) == gains_in[strip]:
-            continue
-        logging.info(f"Setting gain for strip {strip} to {gains_in[strip]}")
-        vmr.inputs[strip].gain = gains_in[strip]
-    for strip in STRIPS_OUT:
-        if round(vmr.outputs[strip].gain, 1) == gains_out[strip]:
-            continue
-        logging.info(f"Setting gain for strip {strip} to {gains_out[strip]}")
-        vmr.outputs[strip].gain = gains_out[strip]
-    changed = False
+def send_values(slots):
+    """Sends the shadowed values of some slots to VRChat in one OSC bundle."""
+    osc_sender.send_some((slot, get_osc_value(slot)) for slot in slots)
+    logging.debug(f"Sent {len(slots)} changed values to VRChat")
 
 
 def set_profile(addr, value):
@@ -125,18 +125,70 @@ def set_profile(addr, value):
         logging.info(f"Setting profile to {addr}")
         vmr.load(get_absolute_path(addr))
     time.sleep(1)
+    if param_sync is not None:
+        # Read back what the profile changed, so VRChat gets the new values.
+        param_sync.reconcile()
     avatar_change(None, None)
 
 
 def avatar_change(addr, value):
-    global vmr
-
     logging.info("Avatar changed/reset...")
+    if osc_sender is None:
+        return
+
+    osc_sender.send(get_osc_value(slot) for slot in range(len(bindings)))
 
-    for strip in STRIPS_IN:
-        osc_client.send_message(f"{PARAMETER_PREFIX_IN}gain_{strip}", get_float_from_voicemeeter_gain(vmr.inputs[strip].gain))
-    for strip in STRIPS_OUT:
-        osc_client.send_message(f"{PARAMETER_PREFIX_OUT}gain_{strip}", get_float_from_voicemeeter_gain(vmr.outputs[strip].gain))
+
+def advertise_endpoints():
+    """Starts the OSCQuery service and advertises all bound parameters."""
+    oscqs.advertise_endpoint(AVATAR_CHANGE_PARAMETER, access="readwrite")
+    oscqs.advertise_endpoint(PARAMETER_RESTART, access="readwrite")
+    for i in range(len(PROFILES)):
+        oscqs.advertise_endpoint(f"{PARAMETER_PREFIX_PROFILE}{i}", access="readwrite")
+
+    addresses = [binding.address for binding in bindings]
+    for slot, address in enumerate(addresses):
+        oscqs.advertise_endpoint(address, get_osc_value(slot), access="readwrite")
+    # Keep the advertised values current, so queries never have to ask Voicemeeter.
+    refresh_values = oscqs.bind_values(addresses, get_osc_value)
+    param_sync.add_shadow_listener(refresh_values)
+    # Catch up on values that changed while the endpoints were advertised.
+    refresh_values(range(len(addresses)))
+
+
+async def run_async():
+    """Runs the OSC server, parameter writer and process watching on one event loop. OSCQuery HTTP keeps its own threads."""
+    global oscqs, qclient
+    from osc import SocketAsyncIOOSCUDPServer
+    loop = asyncio.get_running_loop()
+    server = SocketAsyncIOOSCUDPServer(osc_socket, disp, loop)
+    transport, protocol = await server.create_serve_endpoint()
+    logging.info(f"Starting OSC client on {OSC_SERVER_IP}:{OSC_SERVER_PORT}:{HTTP_PORT}")
+    param_sync.add_listener(send_values)
+    update_writer.start()
+
+    logging.info("Waiting for VRChat to start.")
+    while await loop.run_in_executor(None, vrchat.find) is None:
+        await asyncio.sleep(vrchat.scan_interval)
+    logging.info(f"VRChat started! (PID {vrchat.process.pid})")
+    with startup_phase("discovery"):
+        qclient = await loop.run_in_executor(None, wait_get_oscquery_client)
+    with startup_phase("OSCQuery"):
+        from tinyoscquery.queryservice import OSCQueryService
+        # Served by the threaded keep-alive server, so a slow or idle client never holds up other queries and LISTEN works.
+        oscqs = await loop.run_in_executor(None, OSCQueryService, "VoicemeeterControl", HTTP_PORT, OSC_SERVER_PORT)
+        advertise_endpoints()
+    log_startup_report()
+
+    avatar_change(None, None)
+
+    try:
+        # Wait in slices so the executor thread does not outlive a cancelled loop for long.
+        while not await loop.run_in_executor(None, vrchat.wait_for_exit, vrchat.scan_interval):
+            pass
+    finally:
+        update_writer.stop()
+        transport.close()
 
 
 def osc_server_serve():
@@ -147,27 +199,38 @@ def osc_server_serve():
 def exit():
     logging.info("Exiting...")
     if vmr:
+        logging.debug(f"Parameter cache: {vmr.cache_hits} hits, {vmr.cache_misses} misses")
         vmr.logout()
-    if update_timer:
-        update_timer.stop()
+    if update_writer:
+        update_writer.stop()
+    if dll_executor:
+        dll_executor.shutdown(wait=True, cancel_futures=True)
     if oscqs:
         oscqs.stop()
+    if browser:
+        browser.close()
     sys.exit(0)
 
 
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S', handlers=[logging.StreamHandler()])
+startup_phases = [("imports", STARTUP, time.perf_counter())]
+with startup_phase("config"):
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s', datefmt='%d-%b-%y %H:%M:%S', handlers=[logging.StreamHandler()])
+    conf = json.load(open(get_absolute_path('config.json')))
 
-conf = json.load(open(get_absolute_path('config.json')))
-changed = False
-gains_in = {}
-gains_out = {}
-osc_client: udp_client.SimpleUDPClient = None
+param_sync: ParamSync = None
+bindings = []
+osc_sender: BundleSender = None
 vmr: voicemeeter.remote = None
-server: osc_server.ThreadingOSCUDPServer = None
+osc_socket: socket.socket = None
+server: osc_server.BlockingOSCUDPServer = None
 server_thread: Thread = None
+vrchat: ProcessWatcher = None
+browser: OSCQueryBrowser = None
 qclient: OSCQueryClient = None
 oscqs: OSCQueryService = None
-update_timer: RepeatedTimer = None
+update_writer: SyncWriter = None
+dll_executor: ThreadPoolExecutor = None
+disp: ExactDispatcher = None
 
 KIND = conf['voicemeeter_type']
 STRIPS_IN = conf['strips_in']
@@ -179,11 +242,20 @@ OSC_SERVER_IP = conf['ip']
 HTTP_PORT = conf['http_port']
 MIN_GAIN = conf['min_gain']
 MAX_GAIN = conf['max_gain']
+WRITE_DEBOUNCE = conf.get('write_debounce', 0.005)
+RECONCILE_INTERVAL = conf.get('reconcile_interval', 5.0)
+DIRTY_POLL_INTERVAL = conf.get('dirty_poll_interval', 0.1)
+USE_ASYNCIO = conf.get('asyncio', False)
+MAX_WRITE_RATE = conf.get('max_write_rate', 0)
+RAMP_TIME = conf.get('ramp_time', 0.0)
+BINDINGS = conf.get('bindings', [])
 AVATAR_CHANGE_PARAMETER = "/avatar/change"
+PARAMETER_PREFIX = "/avatar/parameters/"
 PARAMETER_RESTART = "/avatar/parameters/vm_restart"
 PARAMETER_PREFIX_IN = "/avatar/parameters/vm_in_"
 PARAMETER_PREFIX_OUT = "/avatar/parameters/vm_out_"
 PARAMETER_PREFIX_PROFILE = "/avatar/parameters/vm_profile_"
+VRCHAT_PROCESS_NAME = "VRChat.exe" if os.name == 'nt' else "VRChat"
 
 if OSC_SERVER_PORT != 9001:
     logging.info("OSC Server port is not default, testing port availability and advertising OSCQuery endpoints")
@@ -195,17 +267,32 @@ else:
     logging.info("OSC Server port is default.")
 
 try:
-    application = openvr.init(openvr.VRApplication_Utility)
-    openvr.VRApplications().addApplicationManifest(get_absolute_path("app.vrmanifest"))
+    # Packets that arrive before the server is serving wait in the socket's receive buffer.
+    with startup_phase("OSC bind"):
+        osc_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        osc_socket.bind((OSC_SERVER_IP, OSC_SERVER_PORT))
+    logging.info(f"Listening for OSC on {OSC_SERVER_IP}:{OSC_SERVER_PORT}")
+except OSError as e:
+    show_error("You can only bind to the port 9001 once.", "VRCMeeter - Error")
+    logging.error(traceback.format_exc())
+    exit()
+
+try:
+    with startup_phase("OpenVR"):
+        import openvr
+        application = openvr.init(openvr.VRApplication_Utility)
+        openvr.VRApplications().addApplicationManifest(get_absolute_path("app.vrmanifest"))
     logging.info("Added VRManifest.")
-    vmr = voicemeeter.remote(KIND)
-    vmr.login()
+    with startup_phase("login"):
+        import voicemeeter
+        vmr = voicemeeter.remote(KIND)
+        vmr.login()
     logging.info("Logged in to Voicemeeter.")
     if conf["startup_profile"] is not None and conf["startup_profile"] != "":
-        set_profile(conf["startup_profile"], None)
+        with startup_phase("startup profile"):
+            set_profile(conf["startup_profile"], None)
 except Exception as e:
-    if os.name == "nt":
-        ctypes.windll.user32.MessageBoxW(0, traceback.format_exc(), "VRCMeeter - Error", 0)
+    show_error(traceback.format_exc(), "VRCMeeter - Error")
     logging.error(traceback.format_exc())
     exit()
 
@@ -219,75 +306,79 @@ if STRIPS_OUT is None or len(STRIPS_OUT) == 1 and STRIPS_OUT[0] == -1:
 elif len(STRIPS_OUT) == 0:
     STRIPS_OUT = [i for i in range(len(vmr.outputs))]
 
-for strip in STRIPS_IN:
-    gains_in[strip] = round(vmr.inputs[strip].gain, 1)
-    logging.debug(f"IN-{strip} gain: {gains_in[strip]}")
-for strip in STRIPS_OUT:
-    gains_out[strip] = round(vmr.outputs[strip].gain, 1)
-    logging.debug(f"OUT-{strip} gain: {gains_out[strip]}")
-
 try:
-    osc_client = udp_client.SimpleUDPClient(OSC_SERVER_IP, OSC_CLIENT_PORT)
-
-    disp = dispatcher.Dispatcher()
-    disp.map(AVATAR_CHANGE_PARAMETER, avatar_change)
-    disp.map(PARAMETER_RESTART, lambda addr, value: vmr.restart())
-    logging.info(f"Bound restart to {PARAMETER_RESTART}")
-    for i in range(len(PROFILES)):
-        disp.map(f"{PARAMETER_PREFIX_PROFILE}{i}", lambda addr, value: set_profile(int(addr.split('_')[-1]), value))
-        logging.info(f"Bound profile {PROFILES[i]} to {PARAMETER_PREFIX_PROFILE}{i}")
-
-    for strip in STRIPS_IN:
-        disp.map(f"{PARAMETER_PREFIX_IN}gain_{strip}", set_gain_variable_in)
-        logging.info(f"Bound IN-{strip} to {PARAMETER_PREFIX_IN}gain_{strip}")
-
-    for strip in STRIPS_OUT:
-        disp.map(f"{PARAMETER_PREFIX_OUT}gain_{strip}", set_gain_variable_out)
-        logging.info(f"Bound OUT-{strip} to {PARAMETER_PREFIX_OUT}gain_{strip}")
-
-    server = osc_server.BlockingOSCUDPServer((OSC_SERVER_IP, OSC_SERVER_PORT), disp)
-    server_thread = Thread(target=osc_server_serve, daemon=True)
-    server_thread.start()
-
-    logging.info("Waiting for VRChat to start.")
-    while not is_vrchat_running():
-        time.sleep(5)
-    logging.info("VRChat started!")
-    qclient = wait_get_oscquery_client()
-    oscqs = OSCQueryService("VoicemeeterControl", HTTP_PORT, OSC_SERVER_PORT)
-    oscqs.advertise_endpoint(AVATAR_CHANGE_PARAMETER, access="readwrite")
-    oscqs.advertise_endpoint(PARAMETER_RESTART, access="readwrite")
-    for i in range(len(PROFILES)):
-        oscqs.advertise_endpoint(f"{PARAMETER_PREFIX_PROFILE}{i}", access="readwrite")
-
-    for strip in STRIPS_IN:
-        oscqs.advertise_endpoint(f"{PARAMETER_PREFIX_IN}gain_{strip}", access="readwrite")
-
-    for strip in STRIPS_OUT:
-        oscqs.advertise_endpoint(f"{PARAMETER_PREFIX_OUT}gain_{strip}", access="readwrite")
-
-
-    avatar_change(None, None)
-
-    update_timer = RepeatedTimer(0.3, set_gains)
-    update_timer.start()
-    
-    while is_vrchat_running():
-        time.sleep(5)
+    with startup_phase("OSC handlers"):
+        from osc import BundleSender, ExactDispatcher, SocketOSCUDPServer
+        from sync import Binding, DirtyWatcher, ParamSync, SyncWriter
+
+        gain_range = (MIN_GAIN, MAX_GAIN)
+        bindings = [Binding(f"{PARAMETER_PREFIX_IN}gain_{strip}", f"IN-{strip}", vmr.inputs[strip], "gain", gain_range, 0.1, MAX_WRITE_RATE, RAMP_TIME) for strip in STRIPS_IN]
+        bindings += [Binding(f"{PARAMETER_PREFIX_OUT}gain_{strip}", f"OUT-{strip}", vmr.outputs[strip], "gain", gain_range, 0.1, MAX_WRITE_RATE, RAMP_TIME) for strip in STRIPS_OUT]
+        bindings += [make_binding(entry) for entry in BINDINGS]
+        param_sync = ParamSync(vmr, bindings, RECONCILE_INTERVAL)
+        param_sync.reconcile()
+        for slot, binding in enumerate(bindings):
+            logging.debug(f"{binding.name} {binding.prop}: {param_sync.shadow(slot)}")
+
+        osc_sender = BundleSender(OSC_SERVER_IP, OSC_CLIENT_PORT, [binding.address for binding in bindings], ['T' if binding.is_bool else 'f' for binding in bindings])
+        if USE_ASYNCIO:
+            import asyncio
+            from concurrent.futures import ThreadPoolExecutor
+            from async_writer import AsyncSyncWriter
+            dll_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Voicemeeter")
+            update_writer = AsyncSyncWriter(dll_executor, param_sync.sync, WRITE_DEBOUNCE, DirtyWatcher(param_sync).poll, DIRTY_POLL_INTERVAL, lambda: param_sync.due)
+        else:
+            update_writer = SyncWriter(param_sync.sync, WRITE_DEBOUNCE, DirtyWatcher(param_sync).poll, DIRTY_POLL_INTERVAL, lambda: param_sync.due)
+
+        disp = ExactDispatcher()
+        disp.map_exact(AVATAR_CHANGE_PARAMETER, lambda value: avatar_change(AVATAR_CHANGE_PARAMETER, value))
+        disp.map_exact(PARAMETER_RESTART, lambda value: call_voicemeeter(vmr.restart))
+        logging.info(f"Bound restart to {PARAMETER_RESTART}")
+        for i in range(len(PROFILES)):
+            disp.map_exact(f"{PARAMETER_PREFIX_PROFILE}{i}", make_profile_handler(i))
+            logging.info(f"Bound profile {PROFILES[i]} to {PARAMETER_PREFIX_PROFILE}{i}")
+
+        for slot, binding in enumerate(bindings):
+            disp.map_exact(binding.address, make_binding_handler(slot))
+            logging.info(f"Bound {binding.name} {binding.prop} to {binding.address}")
+
+        from process import ProcessWatcher
+        vrchat = ProcessWatcher(VRCHAT_PROCESS_NAME)
+
+    if USE_ASYNCIO:
+        asyncio.run(run_async())
+    else:
+        server = SocketOSCUDPServer(osc_socket, disp)
+        server_thread = Thread(target=osc_server_serve, daemon=True)
+        server_thread.start()
+        param_sync.add_listener(send_values)
+        update_writer.start()
+
+        logging.info("Waiting for VRChat to start.")
+        vrchat.wait_for_start()
+        logging.info(f"VRChat started! (PID {vrchat.process.pid})")
+        with startup_phase("discovery"):
+            qclient = wait_get_oscquery_client()
+        with startup_phase("OSCQuery"):
+            from tinyoscquery.queryservice import OSCQueryService
+            oscqs = OSCQueryService("VoicemeeterControl", HTTP_PORT, OSC_SERVER_PORT)
+            advertise_endpoints()
+        log_startup_report()
+
+        avatar_change(None, None)
+
+        while not vrchat.wait_for_exit(vrchat.scan_interval):
+            pass
 
     logging.info("VRChat closed, exiting.")
     exit()
-except OSError as e:
-    if os.name == "nt":
-        ctypes.windll.user32.MessageBoxW(0, "You can only bind to the port 9001 once.", "VRCMeeter - Error", 0)
-    exit()
-except zeroconf._exceptions.NonUniqueNameException as e:
-    logging.error("NonUniqueNameException, trying again...")
-    os.execv(sys.executable, ['python'] + sys.argv)
 except KeyboardInterrupt:
     exit()
 except Exception as e:
-    if os.name == "nt":
-        ctypes.windll.user32.MessageBoxW(0, traceback.format_exc(), "VRCMeeter - Unexpected Error", 0)
+    from zeroconf import NonUniqueNameException
+    if isinstance(e, NonUniqueNameException):
+        logging.error("NonUniqueNameException, trying again...")
+        os.execv(sys.executable, ['python'] + sys.argv)
+    show_error(traceback.format_exc(), "VRCMeeter - Unexpected Error")
     logging.error(traceback.format_exc())
     exit()
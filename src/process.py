@@ -0,0 +1,56 @@
+import time
+import psutil
+
+
+class ProcessWatcher(object):
+    """
+    Watches for a process by name.
+
+    While the process is not running, the process table is scanned every
+    `scan_interval` seconds, fetching only the name of each process. Once
+    found, the process is kept and its exit is detected by waiting on that
+    single process instead of scanning again.
+    """
+
+    def __init__(self, name: str, scan_interval: float = 5.0):
+        self.name = name
+        self.scan_interval = scan_interval
+        self.process: psutil.Process = None
+
+    def find(self) -> psutil.Process:
+        """Scans the process table once. Returns the process or None."""
+        for p in psutil.process_iter(attrs=['name']):
+            if p.info['name'] == self.name:
+                self.process = p
+                return p
+        self.process = None
+        return None
+
+    def is_running(self) -> bool:
+        if self.process is not None and self.process.is_running():
+            return True
+        return self.find() is not None
+
+    def wait_for_start(self, timeout: float = None) -> psutil.Process:
+        """Blocks until the process runs. Returns the process, or None on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.is_running():
+            wait = self.scan_interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                wait = min(wait, remaining)
+            time.sleep(wait)
+        return self.process
+
+    def wait_for_exit(self, timeout: float = None) -> bool:
+        """Blocks until the process exited. Returns False on timeout."""
+        if self.process is None:
+            return True
+        try:
+            self.process.wait(timeout)
+        except psutil.TimeoutExpired:
+            return False
+        self.process = None
+        return True
@@ -0,0 +1,431 @@
+import logging
+import time
+import math
+import traceback
+from array import array
+from collections import deque
+from threading import Condition, Thread
+
+
+def _invoke(function):
+    """Calls a function, logging instead of raising its exceptions."""
+    try:
+        function()
+    except Exception:
+        logging.error(traceback.format_exc())
+
+
+def _next_call(due) -> float:
+    """Returns the time a writer's `due` function asks for, or math.inf."""
+    if due is None:
+        return math.inf
+    next_call = due()
+    return math.inf if next_call is None else next_call
+
+
+class Mailbox(object):
+    """
+    Latest-value mailbox for incoming parameter updates.
+
+    Every slot holds the most recent value. The first put() to a slot since the
+    last drain queues the slot, so a drain only visits changed slots, no matter
+    how many there are. A single producer (the OSC thread) writes slots by index
+    and a single consumer drains them, so no lock is needed: the consumer clears
+    a slot's flag before reading its value, so a put() racing the drain is either
+    read right away or queues the slot again, and at worst seen twice.
+    """
+
+    def __init__(self, size: int):
+        self.values = array('d', bytes(8 * size))
+        self._queued = bytearray(size)
+        self._pending = deque()
+
+    def __len__(self):
+        return len(self.values)
+
+    def put(self, slot: int, value: float):
+        """Stores the latest value of a slot."""
+        self.values[slot] = value
+        if not self._queued[slot]:
+            self._queued[slot] = 1
+            self._pending.append(slot)
+
+    def drain(self) -> list:
+        """Returns (slot, value) for every slot that changed since the last drain."""
+        changed = []
+        pending = self._pending
+        queued = self._queued
+        while pending:
+            slot = pending.popleft()
+            queued[slot] = 0
+            changed.append((slot, self.values[slot]))
+        return changed
+
+
+# Writes per second of a ramp without a max_rate.
+RAMP_RATE = 30
+
+
+class Binding(object):
+    """
+    An OSC address bound to a property of an input strip or output bus.
+
+    Incoming values from 0 to 1 are mapped to `range` and rounded to a multiple
+    of `step`. Boolean properties are set for values of at least 0.5, and are
+    sent back to VRChat as bools.
+
+    Attributes
+    ----------
+    name : str
+        Name of the element for logging, like IN-0
+    range : tuple
+        (lo, hi) of the property, defaults to the range the property declares
+    step : float
+        Quantization step of the property, or None to write values as they come
+    max_rate : float
+        Maximum writes per second to the property, 0 for no limit. Ramps are
+        written at RAMP_RATE writes per second when no limit is given.
+    ramp : float
+        Seconds a float property takes to move across its whole range, 0 to jump
+        to new values right away
+    """
+
+    def __init__(self, address: str, name: str, element, prop: str, range=None, step=None, max_rate: float = 0, ramp: float = 0.0):
+        declared = getattr(type(element), prop, None)
+        if not isinstance(declared, property) or declared.fset is None:
+            raise ValueError(f"{name} has no settable property {prop}")
+        param_type = getattr(declared, 'type', float)
+        if param_type not in (bool, float):
+            raise ValueError(f"Cannot bind {name}.{prop}, only bool and float properties can be bound")
+
+        self.address = address
+        self.name = name
+        self.element = element
+        self.prop = prop
+        self.is_bool = param_type is bool
+        self._property = declared
+        # (param, string) for VMRemote.snapshot()
+        self.param = element.params([prop])[0]
+        self.range = tuple(range or getattr(declared, 'range', None) or (0.0, 1.0))
+        self.step = step
+        self.ramp = 0.0 if self.is_bool else ramp
+        if not max_rate and self.ramp:
+            max_rate = RAMP_RATE
+        self.write_interval = 1 / max_rate if max_rate else 0.0
+
+    def quantize(self, value):
+        if self.is_bool:
+            return bool(value)
+        if self.step:
+            value = round(round(value / self.step) * self.step, 6)
+        return value
+
+    def equals(self, a, b) -> bool:
+        """True iff two property values are the same, Voicemeeter stores floats in single precision."""
+        if a is None or b is None:
+            return a is b
+        return self._property.equals(a, b)
+
+    def to_param(self, value: float):
+        """Maps an incoming OSC value to a property value."""
+        if self.is_bool:
+            return value >= 0.5
+        lo, hi = self.range
+        return self.quantize(lo + min(max(value, 0.0), 1.0) * (hi - lo))
+
+    def approach(self, position, target, elapsed: float):
+        """Moves an unquantized position towards a target, as far as the ramp allows in `elapsed` seconds."""
+        if not self.ramp:
+            return target
+        lo, hi = self.range
+        distance = abs(hi - lo) / self.ramp * elapsed
+        if abs(target - position) <= distance:
+            return target
+        return position + math.copysign(distance, target - position)
+
+    def to_osc(self, value):
+        """Maps a property value to the value sent to VRChat."""
+        if self.is_bool:
+            return bool(value)
+        lo, hi = self.range
+        return (value - lo) / (hi - lo)
+
+    def read(self):
+        return self.quantize(getattr(self.element, self.prop))
+
+    def write(self, value):
+        setattr(self.element, self.prop, value)
+
+
+class ParamSync(object):
+    """
+    Writes parameter updates from a mailbox to Voicemeeter.
+
+    Keeps a shadow of the value it last wrote and of the value Voicemeeter last
+    reported for every slot, and only writes when the target differs from the
+    shadow. Voicemeeter is read back in reconcile(), which runs at most every
+    `reconcile_interval` seconds from sync() or whenever a watcher asks for it,
+    so a sync() in the steady state issues no reads.
+
+    Slots whose binding limits its write rate or ramps stay active until they
+    reached their target. Every sync() writes each due slot once, with the
+    latest target or the next step of its ramp, so values that arrive in between
+    are dropped. `due` is the time sync() has to be called again for them.
+
+    Attributes
+    ----------
+    slots : list
+        A Binding per slot
+    """
+
+    def __init__(self, vmr, slots: list, reconcile_interval: float = 5.0):
+        self.vmr = vmr
+        self.slots = slots
+        self.reconcile_interval = reconcile_interval
+        self.mailbox = Mailbox(len(slots))
+        self.written = [None] * len(slots)
+        self.reported = [None] * len(slots)
+        self.listeners = []
+        self.shadow_listeners = []
+        self.due = None
+        self._reconciled = None
+        # Per slot: target, unquantized ramp position, time the position was last
+        # moved and time of the last write. _active is an ordered set of the slots
+        # that did not reach their target yet.
+        self._targets = [None] * len(slots)
+        self._positions = [None] * len(slots)
+        self._moved = [0.0] * len(slots)
+        self._written_at = [-math.inf] * len(slots)
+        self._active = {}
+
+    def shadow(self, slot: int):
+        """Returns the value Voicemeeter is believed to have for a slot."""
+        written = self.written[slot]
+        return self.reported[slot] if written is None else written
+
+    def add_listener(self, listener):
+        """Registers listener(slots), called with the slots reconcile() found changed."""
+        self.listeners.append(listener)
+
+    def add_shadow_listener(self, listener):
+        """Registers listener(slots), called with the slots whose shadow changed, by reconcile() or by a write."""
+        self.shadow_listeners.append(listener)
+
+    def reconcile_due(self) -> bool:
+        """True if the last reconcile() is at least `reconcile_interval` seconds ago."""
+        return self._reconciled is None or time.monotonic() - self._reconciled >= self.reconcile_interval
+
+    def reconcile(self) -> list:
+        """
+        Reads all bound parameters back from Voicemeeter, in one snapshot.
+
+        Returns the slots whose reported value differs from the shadow.
+        """
+        self.vmr.snapshot([binding.param for binding in self.slots])
+        changed = []
+        for slot, binding in enumerate(self.slots):
+            value = binding.read()
+            if not binding.equals(value, self.shadow(slot)):
+                changed.append(slot)
+            self.reported[slot] = value
+            self.written[slot] = None
+        self._reconciled = time.monotonic()
+        if changed:
+            for listener in self.listeners:
+                listener(changed)
+            for listener in self.shadow_listeners:
+                listener(changed)
+        return changed
+
+    def sync(self) -> int:
+        """Writes all changed parameters in one batch. Returns the number of writes."""
+        if self.reconcile_due():
+            self.reconcile()
+
+        now = time.monotonic()
+        for slot, value in self.mailbox.drain():
+            binding = self.slots[slot]
+            self._targets[slot] = binding.to_param(value)
+            if slot not in self._active:
+                self._active[slot] = None
+                self._positions[slot] = self.shadow(slot)
+                # A ramp that starts now makes one write interval of progress on its first write.
+                self._moved[slot] = now - binding.write_interval
+        if not self._active:
+            self.due = None
+            return 0
+
+        written = []
+        due = math.inf
+        with self.vmr.batch():
+            for slot in list(self._active):
+                binding = self.slots[slot]
+                next_write = self._written_at[slot] + binding.write_interval
+                if now < next_write:
+                    due = min(due, next_write)
+                    continue
+                target = self._targets[slot]
+                position = binding.approach(self._positions[slot], target, now - self._moved[slot])
+                self._positions[slot] = position
+                self._moved[slot] = now
+                if position == target:
+                    del self._active[slot]
+                else:
+                    due = min(due, now + binding.write_interval)
+                value = binding.quantize(position)
+                if binding.equals(value, self.shadow(slot)):
+                    continue
+                logging.info(f"Setting {binding.prop} for {binding.name} to {value}")
+                binding.write(value)
+                self.written[slot] = value
+                self._written_at[slot] = now
+                written.append(slot)
+        self.due = None if due == math.inf else due
+        if written:
+            for listener in self.shadow_listeners:
+                listener(written)
+        return len(written)
+
+
+class DirtyWatcher(object):
+    """
+    Reconciles a ParamSync whenever Voicemeeter reports dirty parameters, and
+    at least every `reconcile_interval` seconds while it does not.
+
+    Our own writes raise the dirty flag as well. Their reconcile finds the
+    values it wrote, so nothing is sent back to VRChat for them.
+
+    Meant to be polled from the thread that owns the Voicemeeter connection,
+    see SyncWriter's poll argument.
+    """
+
+    def __init__(self, param_sync: ParamSync):
+        self.param_sync = param_sync
+        self._dirty_count = param_sync.vmr.dirty_count
+
+    def poll(self) -> list:
+        """Checks the dirty flag once. Returns the slots that changed in Voicemeeter."""
+        vmr = self.param_sync.vmr
+        vmr.dirty
+        # Compare counts, the flag may already have been consumed by a cached read.
+        if vmr.dirty_count == self._dirty_count and not self.param_sync.reconcile_due():
+            return []
+        self._dirty_count = vmr.dirty_count
+        return self.param_sync.reconcile()
+
+
+class SyncWriter(Thread):
+    """
+    Runs a sync function on a dedicated thread whenever it gets notified.
+
+    Notifications that arrive within `debounce` seconds of the first one are
+    coalesced into a single call. Without notifications the thread sleeps, or
+    wakes up every `poll_interval` seconds to call `poll` if one is given.
+    If `due` is given, it is called after every call of the sync function and
+    returns the time.monotonic() at which the function wants to be called
+    again without a notification, or None. Other functions that have to run
+    on the writer's thread are passed to submit().
+    """
+
+    def __init__(self, function, debounce: float = 0.005, poll=None, poll_interval: float = 0.1, due=None):
+        super().__init__(name="SyncWriter", daemon=True)
+        self.function = function
+        self.debounce = debounce
+        self.poll = poll
+        self.poll_interval = poll_interval
+        self.due = due
+        self._cond = Condition()
+        self._pending = False
+        self._stopped = False
+        self._calls = deque()
+
+    def submit(self, function, *args):
+        """Calls function(*args) on the writer's thread, before the next sync."""
+        with self._cond:
+            self._calls.append((function, args))
+            self._cond.notify()
+
+    def notify(self):
+        """Schedules a call of the sync function."""
+        if self._pending:
+            # Already scheduled, the flag is cleared before the next call starts.
+            return
+        with self._cond:
+            if not self._pending:
+                self._pending = True
+                self._cond.notify()
+
+    def stop(self):
+        """Stops the thread after the current call has finished."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def run(self):
+        next_poll = time.monotonic() + self.poll_interval if self.poll is not None else math.inf
+        next_call = math.inf
+        while True:
+            with self._cond:
+                while not self._pending and not self._calls and not self._stopped:
+                    deadline = min(next_poll, next_call)
+                    if deadline == math.inf:
+                        self._cond.wait()
+                        continue
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                pending = self._pending
+                calls, self._calls = self._calls, deque()
+            for function, args in calls:
+                _invoke(lambda: function(*args))
+            if pending or time.monotonic() >= next_call:
+                if pending and self.debounce > 0:
+                    time.sleep(self.debounce)
+                with self._cond:
+                    self._pending = False
+                _invoke(self.function)
+                next_call = _next_call(self.due)
+            if self.poll is not None and time.monotonic() >= next_poll:
+                _invoke(self.poll)
+                next_poll = time.monotonic() + self.poll_interval
+
+
+if __name__ == "__main__":
+    # Benchmark on the fake driver: one gesture sweeps a gain slider from 0 to 1
+    # in 0.5 s with 100 OSC updates, counting the writes that reach Voicemeeter
+    # and how long after the last update the slider settles on its target.
+    import os
+    os.environ.setdefault('VMR_BACKEND', 'fake')
+    import voicemeeter
+
+    vmr = voicemeeter.remote('potato')
+    vmr.login()
+    fake = vmr.backend
+    writes = []
+    write = fake._write
+    fake._write = lambda param, val: writes.append(param) or write(param, val)
+
+    updates = 100
+    for name, max_rate, ramp in (("no limit", 0, 0.0), ("20 writes/s", 20, 0.0), ("0.25 s ramp", 0, 0.25)):
+        binding = Binding("/avatar/parameters/vm_in_gain_0", "IN-0", vmr.inputs[0], "gain", (-60, 0), 0.1, max_rate, ramp)
+        param_sync = ParamSync(vmr, [binding], reconcile_interval=3600)
+        vmr.inputs[0].gain = -60
+        param_sync.reconcile()
+        writer = SyncWriter(param_sync.sync, due=lambda: param_sync.due)
+        writer.start()
+        writes.clear()
+        batches = fake.calls['SetParametersW']
+        for i in range(1, updates + 1):
+            param_sync.mailbox.put(0, i / updates)
+            writer.notify()
+            time.sleep(0.5 / updates)
+        end = time.monotonic()
+        while param_sync.shadow(0) != 0 or param_sync.due is not None:
+            time.sleep(0.001)
+        settled = time.monotonic() - end
+        writer.stop()
+        writer.join()
+        print(f"{name:>12}: {len(writes):3} writes in {fake.calls['SetParametersW'] - batches:3} batches for {updates} updates, settled {settled * 1e3:4.0f} ms after the gesture")
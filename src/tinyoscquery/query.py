@@ -1,61 +1,187 @@
-import time
+import sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
 from zeroconf import ServiceBrowser, ServiceInfo, ServiceListener, Zeroconf
 import requests
 
 from .shared.node import OSCQueryNode, OSC_Type_String_to_Python_Type, OSCAccess, OSCHostInfo
 
 class OSCQueryListener(ServiceListener):
+    """
+    Collects resolved OSC and OSCQuery services.
 
-    def __init__(self) -> None:
+    The Zeroconf callbacks never block: a service is resolved from the Zeroconf cache
+    if its records came with the announcement, otherwise on one of `max_workers`
+    resolver threads. Resolved services are stored under a lock, so the service
+    dicts should be read through services().
+    """
+
+    def __init__(self, max_workers=4) -> None:
         self.osc_services = {}
         self.oscjson_services = {}
+        # Bumped on every change of the services, see wait_for_change()
+        self.generation = 0
+        self._changed = threading.Condition()
+        # name -> number of the latest add/update/remove, to drop stale resolutions
+        self._requests = {}
+        self._resolver = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="OSCQueryResolver")
 
         super().__init__()
 
-    def remove_service(self, zc: 'Zeroconf', type_: str, name: str) -> None:
-        if name in self.osc_services:
-            del self.osc_services[name]
+    def _services_of_type(self, type_):
+        if type_ == '_osc._udp.local.':
+            return self.osc_services
+        elif type_ == '_oscjson._tcp.local.':
+            return self.oscjson_services
+        return None
 
-        if name in self.oscjson_services:
-            del self.oscjson_services[name]
+    def services(self, type_) -> list:
+        """ Returns the resolved ServiceInfos of a service type. """
+        with self._changed:
+            return list(self._services_of_type(type_).values())
+
+    def _notify(self):
+        self.generation += 1
+        self._changed.notify_all()
+
+    def _request(self, name) -> int:
+        with self._changed:
+            request = self._requests.get(name, 0) + 1
+            self._requests[name] = request
+            return request
+
+    def _store(self, type_, name, request, info):
+        with self._changed:
+            if self._requests.get(name) != request:
+                return
+            self._services_of_type(type_)[name] = info
+            self._notify()
+
+    def _resolve(self, zc, type_, name, request):
+        try:
+            info = zc.get_service_info(type_, name)
+        except Exception:
+            # Zeroconf was closed while resolving
+            return
+        if info is not None:
+            self._store(type_, name, request, info)
+
+    def _lookup(self, zc, type_, name):
+        if self._services_of_type(type_) is None:
+            return
+        request = self._request(name)
+        info = ServiceInfo(type_, name)
+        if info.load_from_cache(zc):
+            self._store(type_, name, request, info)
+        else:
+            try:
+                self._resolver.submit(self._resolve, zc, type_, name, request)
+            except RuntimeError:
+                # The listener has been closed
+                pass
+
+    def close(self, wait=False):
+        """ Stops resolving. With wait=True, blocks until running resolutions have timed out. """
+        self._resolver.shutdown(wait=wait, cancel_futures=True)
+
+    def wait_for_change(self, generation, timeout=None) -> int:
+        """
+        Blocks until the services changed after `generation` was read, or the timeout expired.
+        Returns the current generation.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.generation != generation, timeout)
+            return self.generation
+
+    def remove_service(self, zc: 'Zeroconf', type_: str, name: str) -> None:
+        self._request(name)
+        with self._changed:
+            services = self._services_of_type(type_)
+            if services is not None and name in services:
+                del services[name]
+                self._notify()
 
     def add_service(self, zc: 'Zeroconf', type_: str, name: str) -> None:
-        if type_ == '_osc._udp.local.':
-            self.osc_services[name] = zc.get_service_info(type_, name)
-        elif type_ == '_oscjson._tcp.local.':
-            self.oscjson_services[name] = zc.get_service_info(type_, name)
+        self._lookup(zc, type_, name)
 
     def update_service(self, zc: 'Zeroconf', type_: str, name: str) -> None:
-        if type_ == '_osc._udp.local.':
-            self.osc_services[name] = zc.get_service_info(type_, name)
-        elif type_ == '_oscjson._tcp.local.':
-            self.oscjson_services[name] = zc.get_service_info(type_, name)
+        self._lookup(zc, type_, name)
 
 
 class OSCQueryBrowser(object):
+    """
+    Browses the local network for OSC and OSCQuery services.
+
+    Meant to be long-lived: discovery runs in the background for as long as the
+    browser is open, and wait_for_service() wakes up as soon as services change.
+    Call close() to release the Zeroconf instance.
+    """
     def __init__(self) -> None:
         self.listener = OSCQueryListener()
         self.zc = Zeroconf()
         self.browser = ServiceBrowser(self.zc, ["_oscjson._tcp.local.", "_osc._udp.local."], self.listener)
+        self.clients = {}
 
     def get_discovered_osc(self):
-        return [oscsvc[1] for oscsvc in self.listener.osc_services.items()]
+        return self.listener.services('_osc._udp.local.')
 
     def get_discovered_oscquery(self):
-        return [oscjssvc[1] for oscjssvc in self.listener.oscjson_services.items()]
+        return self.listener.services('_oscjson._tcp.local.')
+
+    def get_client(self, service_info) -> 'OSCQueryClient':
+        """
+        Returns the client for a discovered service. Clients are kept per ServiceInfo, so their
+        connections and HOST_INFO are reused until the service is updated or removed.
+        """
+        client = self.clients.get(service_info.name)
+        if client is None or client.service_info is not service_info:
+            if client is not None:
+                client.close()
+            client = OSCQueryClient(service_info)
+            self.clients[service_info.name] = client
+        return client
 
     def find_service_by_name(self, name):
         for svc in self.get_discovered_oscquery():
-            client = OSCQueryClient(svc)
-            if name in client.get_host_info().name:
+            hi = self.get_client(svc).get_host_info()
+            if hi is not None and name in hi.name:
                 return svc
 
         return None
 
+    def wait_for_service(self, name, timeout=None, retry_interval=1.0):
+        """
+        Blocks until an OSCQuery service whose HOST_INFO name contains `name` is discovered.
+        Returns its ServiceInfo, or None if the timeout expired first.
+
+        Services are checked whenever discovery reports a change, and every
+        `retry_interval` seconds for services that did not answer HOST_INFO yet.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        generation = self.listener.generation
+        while True:
+            svc = self.find_service_by_name(name)
+            if svc is not None:
+                return svc
+            wait = retry_interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                wait = min(wait, remaining)
+            generation = self.listener.wait_for_change(generation, wait)
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients.clear()
+        self.browser.cancel()
+        self.listener.close()
+        self.zc.close()
+
     def find_nodes_by_endpoint_address(self, address) -> list[tuple[ServiceInfo, OSCHostInfo, OSCQueryNode]]:
         svcs = []
         for svc in self.get_discovered_oscquery():
-            client = OSCQueryClient(svc)
+            client = self.get_client(svc)
             hi = client.get_host_info()
             if hi is None:
                 continue
@@ -67,7 +193,19 @@ class OSCQueryBrowser(object):
 
 
 class OSCQueryClient(object):
-    def __init__(self, service_info) -> None:
+    """
+    Queries an OSCQuery service over a persistent HTTP session.
+
+    Node queries are sent with If-None-Match, so unchanged nodes are answered with
+    an empty 304 and served from the last response. HOST_INFO is fetched once and
+    cached, pass refresh=True to get_host_info() to fetch it again.
+
+    Attributes
+    ----------
+    timeout : float or tuple
+        Timeout of every request in seconds, as (connect, read) or a single value for both.
+    """
+    def __init__(self, service_info, timeout=(1.0, 3.0)) -> None:
         if not isinstance(service_info, ServiceInfo):
             raise Exception("service_info isn't a ServiceInfo class!")
 
@@ -75,7 +213,35 @@ class OSCQueryClient(object):
             raise Exception("service_info does not represent an OSCQuery service!")
 
         self.service_info = service_info
+        self.timeout = timeout
         self.last_json = None
+        self.host_info = None
+        self.session = requests.Session()
+        # OSCQuery services live on the local network, skip looking up proxies and .netrc per request.
+        self.session.trust_env = False
+        # url -> (etag, json) of the last 200 response
+        self._responses = {}
+
+    def close(self):
+        self.session.close()
+
+    def _get_json(self, url):
+        """
+        GETs a JSON document. Returns (status_code, json), or (status_code, content)
+        if the status is neither 200 nor 304.
+        """
+        cached = self._responses.get(url)
+        headers = {"If-None-Match": cached[0]} if cached is not None else None
+        r = self.session.get(url, headers=headers, timeout=self.timeout)
+        if r.status_code == 304 and cached is not None:
+            return 200, cached[1]
+        if r.status_code != 200:
+            return r.status_code, r.content
+        json = r.json()
+        etag = r.headers.get("ETag")
+        if etag is not None:
+            self._responses[url] = (etag, json)
+        return 200, json
 
     def _get_query_root(self):
         return f"http://{self._get_ip_str()}:{self.service_info.port}"
@@ -86,40 +252,37 @@ class OSCQueryClient(object):
 
     def query_node(self, node="/"):
         url = self._get_query_root() + node
-        r = None
         try:
-            r = requests.get(url)
+            status, json = self._get_json(url)
         except Exception as ex:
             print("Error querying node...", ex)
-        if r is None:
             return None
 
-        if r.status_code == 404:
+        if status == 404:
             return None
         
-        if r.status_code != 200:
-            raise Exception("Node query error: (HTTP", r.status_code, ") ", r.content)
+        if status != 200:
+            raise Exception("Node query error: (HTTP", status, ") ", json)
 
-        self.last_json = r.json()
+        self.last_json = json
 
         return self._make_node_from_json(self.last_json)
 
 
-    def get_host_info(self):
+    def get_host_info(self, refresh=False):
+        if self.host_info is not None and not refresh:
+            return self.host_info
+
         url = self._get_query_root() + "/HOST_INFO"
-        r = None
         try:
-            r = requests.get(url)
+            status, json = self._get_json(url)
         except Exception as ex:
             #print("Error querying HOST_INFO...", ex)
-            pass
-        if r is None:
             return None
 
-        if r.status_code != 200:
-            raise Exception("Node query error: (HTTP", r.status_code, ") ", r.content)
+        if status != 200:
+            raise Exception("Node query error: (HTTP", status, ") ", json)
 
-        json = r.json()
         hi = OSCHostInfo(json["NAME"], json['EXTENSIONS'])
         if 'OSC_IP' in json:
             hi.osc_ip = json["OSC_IP"]
@@ -136,16 +299,17 @@ class OSCQueryClient(object):
         else:
             hi.osc_transport = "UDP"
 
+        self.host_info = hi
         return hi
 
     def _make_node_from_json(self, json):
-        newNode = OSCQueryNode()
-
+        subNodes = None
         if "CONTENTS" in json:
-            subNodes = []
+            subNodes = {}
             for subNode in json["CONTENTS"]:
-                subNodes.append(self._make_node_from_json(json["CONTENTS"][subNode]))
-            newNode.contents = subNodes
+                subNodes[subNode] = self._make_node_from_json(json["CONTENTS"][subNode])
+
+        newNode = OSCQueryNode(contents=subNodes)
 
         # This *should* be required but some implementations don't have it...
         if "FULL_PATH" in json:
@@ -181,7 +345,55 @@ class OSCQueryClient(object):
 
 
 
-if __name__ == "__main__":
+def _benchmark_discovery(live=40, unresponsive=8):
+    """
+    Announces `live` services and `unresponsive` names that never answer resolution from a local
+    stand-in mDNS responder, and measures how long a browser takes to resolve all live services
+    with the old blocking resolution in the Zeroconf callback and with OSCQueryListener.
+    """
+    import socket
+    from zeroconf import DNSOutgoing, DNSPointer, const
+
+    class BlockingListener(OSCQueryListener):
+        def _lookup(self, zc, type_, name):
+            info = zc.get_service_info(type_, name)
+            if info is not None:
+                self._store(type_, name, self._request(name), info)
+
+    type_ = "_oscjson._tcp.local."
+    responder = Zeroconf()
+    for i in range(live):
+        responder.register_service(ServiceInfo(type_, f"bench-live-{i}.{type_}", addresses=[socket.inet_aton("127.0.0.1")],
+            port=20000 + i, server="bench.local."), cooperating_responders=True, strict=False)
+
+    def announce_unresponsive():
+        # Only the PTR record: browsers see the names but resolving them times out.
+        out = DNSOutgoing(const._FLAGS_QR_RESPONSE | const._FLAGS_AA)
+        for i in range(unresponsive):
+            out.add_answer_at_time(DNSPointer(type_, const._TYPE_PTR, const._CLASS_IN, const._DNS_OTHER_TTL, f"bench-dead-{i}.{type_}"), 0)
+        responder.send(out)
+
+    for listener_class in (BlockingListener, OSCQueryListener):
+        zc = Zeroconf()
+        listener = listener_class()
+        start = time.monotonic()
+        announce_unresponsive()
+        browser = ServiceBrowser(zc, [type_], listener)
+        generation = listener.generation
+        while len(listener.services(type_)) < live and time.monotonic() - start < 60:
+            generation = listener.wait_for_change(generation, 1.0)
+        elapsed = time.monotonic() - start
+        print(f"{listener_class.__name__:>17}: {len(listener.services(type_))}/{live} live services resolved after {elapsed:.2f} s")
+        browser.cancel()
+        listener.close(wait=True)
+        zc.close()
+
+    responder.close()
+
+
+if __name__ == "__main__" and "--bench" in sys.argv:
+    _benchmark_discovery()
+elif __name__ == "__main__":
     browser = OSCQueryBrowser()
     time.sleep(2) # Wait for discovery
 
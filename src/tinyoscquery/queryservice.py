@@ -1,7 +1,11 @@
 from zeroconf import ServiceInfo, Zeroconf
-from http.server import SimpleHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 from .shared.node import OSCQueryNode, OSCHostInfo, OSCAccess
-import json, threading
+import base64, hashlib, json, socket, struct, threading, time, zlib
+from collections import deque
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
 
 
 class OSCQueryService(object):
@@ -16,30 +20,45 @@ class OSCQueryService(object):
         Desired TCP port number for the oscjson HTTP server
     oscPort : int
         Desired UDP port number for the osc server
+    httpThread : bool
+        Serve HTTP on a thread of its own. If False, the caller has to call http_server.handle_request()
+        repeatedly, e.g. on an executor of an event loop. Requests are handled on the calling thread.
+    threaded : bool
+        Handle every connection on its own thread with HTTP/1.1 keep-alive and WebSocket LISTEN support.
+        If False, requests are served one after another and every connection is closed after its response.
     """
     
-    def __init__(self, serverName, httpPort, oscPort, oscIp="127.0.0.1") -> None:
+    def __init__(self, serverName, httpPort, oscPort, oscIp="127.0.0.1", httpThread=True, threaded=True) -> None:
         self.serverName = serverName
         self.httpPort = httpPort
         self.oscPort = oscPort
         self.oscIp = oscIp
 
         self.root_node = OSCQueryNode("/", description="root node")
-        self.host_info = OSCHostInfo(serverName, {"ACCESS":True,"CLIPMODE":False,"RANGE":True,"TYPE":True,"VALUE":True}, 
+        self.host_info = OSCHostInfo(serverName, {"ACCESS":True,"CLIPMODE":False,"RANGE":True,"TYPE":True,"VALUE":True,"LISTEN":threaded}, 
             self.oscIp, self.oscPort, "UDP")
 
         self._zeroconf = Zeroconf()
         self._startOSCQueryService()
         self._advertiseOSCService()
-        self.http_server = OSCQueryHTTPServer(self.root_node, self.host_info, ('', self.httpPort), OSCQueryHTTPHandler)
-        self.http_thread = threading.Thread(target=self._startHTTPServer)
-        self.http_thread.start()
+        if threaded:
+            self.http_server = ThreadingOSCQueryHTTPServer(self.root_node, self.host_info, ('', self.httpPort), KeepAliveOSCQueryHTTPHandler)
+        else:
+            self.http_server = OSCQueryHTTPServer(self.root_node, self.host_info, ('', self.httpPort), OSCQueryHTTPHandler)
+        self.http_thread = None
+        if httpThread:
+            self.http_thread = threading.Thread(target=self._startHTTPServer)
+            self.http_thread.start()
 
     def stop(self):
-        self.http_server.shutdown()
+        if self.http_thread is not None:
+            self.http_server.shutdown()
+        self.http_server.close_listeners()
+        self.http_server.server_close()
 
     def add_node(self, node):
-        self.root_node.add_child_node(node)
+        with self.http_server.tree_lock:
+            self.root_node.add_child_node(node)
 
     def advertise_endpoint(self, address, value=None, access=OSCAccess.READWRITE_VALUE):
         new_node = OSCQueryNode(full_path=address, access=access)
@@ -51,6 +70,36 @@ class OSCQueryService(object):
                 new_node.value = value
                 new_node.type_ = [type(v) for v in value]
         self.add_node(new_node)
+        if value is not None:
+            self.http_server.notify_listeners(address, new_node.value)
+
+    def update_value(self, address, value):
+        """
+        Changes the value of an advertised endpoint and pushes it as an OSC message
+        to all WebSocket clients that LISTEN to the address.
+        """
+        values = value if isinstance(value, list) else [value]
+        with self.http_server.tree_lock:
+            node = self.root_node.find_subnode(address)
+            if node is None:
+                raise Exception(f"No endpoint advertised at {address}!")
+            if node.type_ is None:
+                node.type_ = [type(v) for v in values]
+            node.value = values
+        self.http_server.notify_listeners(address, values)
+
+    def bind_values(self, addresses, get_value):
+        """
+        Binds the values of advertised endpoints to a live source.
+
+        Returns a function refresh(indices), that sets the value of addresses[i] to get_value(i)
+        for every given index. Register it as change listener of the source, so queries
+        are answered from the node tree without asking the source.
+        """
+        def refresh(indices):
+            for i in indices:
+                self.update_value(addresses[i], get_value(i))
+        return refresh
 
     def _startOSCQueryService(self):
         oscqsDesc = {'txtvers': 1}
@@ -75,28 +124,300 @@ class OSCQueryHTTPServer(HTTPServer):
         super().__init__(server_address, RequestHandlerClass, bind_and_activate)
         self.root_node = root_node
         self.host_info = host_info
+        # Guards the node tree, so a response is never encoded while a value changes
+        self.tree_lock = threading.Lock()
+        # address -> set of OSCQueryWebSocket that LISTEN to it
+        self.listeners = {}
+        self.listeners_lock = threading.Lock()
 
+    def notify_listeners(self, address, values):
+        """ Sends an OSC message with the values to every WebSocket listening to the address. """
+        with self.listeners_lock:
+            sockets = list(self.listeners.get(address, ()))
+        if not sockets:
+            return
+        message = encode_osc_message(address, values)
+        for ws in sockets:
+            ws.send_binary(message)
 
-class OSCQueryHTTPHandler(SimpleHTTPRequestHandler):
-    def do_GET(self) -> None:
+    def close_listeners(self):
+        with self.listeners_lock:
+            sockets = set().union(*self.listeners.values())
+        for ws in sockets:
+            ws.close()
+
+
+class ThreadingOSCQueryHTTPServer(ThreadingMixIn, OSCQueryHTTPServer):
+    daemon_threads = True
+
+
+class OSCQueryWebSocket(object):
+    """
+    A WebSocket connection using the OSCQuery LISTEN/IGNORE commands.
+
+    Frames are queued and written by a sender thread of the connection, so sending
+    never blocks the caller. A client with more than `max_queued` unsent frames
+    stopped reading and is disconnected.
+    """
+    max_queued = 256
+
+    def __init__(self, server, connection, rfile) -> None:
+        self.server = server
+        self.connection = connection
+        self.rfile = rfile
+        self.paths = set()
+        self._outbox = deque()
+        self._outbox_ready = threading.Condition()
+        self._closing = False
+        self._sender = threading.Thread(target=self._send_queued, daemon=True)
+        self._sender.start()
+
+    def _read_frame(self):
+        head = self.rfile.read(2)
+        if len(head) < 2:
+            return None, None
+        opcode = head[0] & 0x0F
+        length = head[1] & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if head[1] & 0x80 else None
+        payload = self.rfile.read(length)
+        if mask is not None:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return opcode, payload
+
+    def _send_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack(">BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, length)
+        try:
+            self.connection.sendall(header + payload)
+        except OSError:
+            pass
+
+    def _send_queued(self):
+        while True:
+            with self._outbox_ready:
+                while not self._outbox:
+                    if self._closing:
+                        return
+                    self._outbox_ready.wait()
+                opcode, payload = self._outbox.popleft()
+            self._send_frame(opcode, payload)
+            if opcode == 0x8:
+                self._shutdown()
+                return
+
+    def _queue_frame(self, opcode, payload):
+        with self._outbox_ready:
+            if self._closing:
+                return
+            if len(self._outbox) < self.max_queued:
+                self._outbox.append((opcode, payload))
+                self._outbox_ready.notify()
+                return
+            # The client stopped reading, drop it.
+            self._closing = True
+            self._outbox.clear()
+            self._outbox_ready.notify()
+        self._shutdown()
+
+    def _shutdown(self):
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send_binary(self, payload):
+        self._queue_frame(0x2, payload)
+
+    def close(self):
+        """ Sends a close frame after the queued frames and shuts the connection down. """
+        with self._outbox_ready:
+            if self._closing:
+                return
+            self._outbox.append((0x8, b""))
+            self._closing = True
+            self._outbox_ready.notify()
+
+    def _handle_command(self, payload):
+        try:
+            command = json.loads(payload)
+            name, path = command["COMMAND"], command["DATA"]
+        except (ValueError, KeyError, TypeError):
+            return
+        with self.server.listeners_lock:
+            if name == "LISTEN":
+                self.paths.add(path)
+                self.server.listeners.setdefault(path, set()).add(self)
+            elif name == "IGNORE":
+                self.paths.discard(path)
+                self.server.listeners.get(path, set()).discard(self)
+
+    def serve(self):
+        try:
+            while True:
+                opcode, payload = self._read_frame()
+                if opcode is None or opcode == 0x8:
+                    break
+                if opcode == 0x1:
+                    self._handle_command(payload)
+                elif opcode == 0x9:
+                    self._queue_frame(0xA, payload)
+        except OSError:
+            pass
+        finally:
+            with self.server.listeners_lock:
+                for path in self.paths:
+                    self.server.listeners.get(path, set()).discard(self)
+            self.close()
+
+
+class OSCQueryHTTPHandler(BaseHTTPRequestHandler):
+    # A client that connects and sends nothing must not hold up the server for long.
+    timeout = 5
+
+    def _get_response(self):
         if 'HOST_INFO' in self.path:
-            self.send_response(200)
-            self.send_header("Content-type", "text/json")
-            self.end_headers()
-            self.wfile.write(bytes(str(self.server.host_info.to_json()), 'utf-8'))
+            return 200, "application/json", bytes(str(self.server.host_info.to_json()), 'utf-8')
+        with self.server.tree_lock:
+            node = self.server.root_node.find_subnode(self.path)
+            if node is None:
+                return 404, "text/plain", bytes("OSC Path not found", 'utf-8')
+            return 200, "application/json", node.to_json_bytes()
+
+    def _respond(self, send_body) -> None:
+        status, content_type, body = self._get_response()
+        if status == 200:
+            etag = '"%08x"' % zlib.crc32(body)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 200:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.headers.get("Upgrade", "").lower() == "websocket" and self.protocol_version == "HTTP/1.1":
+            self._serve_websocket()
             return
-        node = self.server.root_node.find_subnode(self.path)
-        if node is None:
-            self.send_response(404)
-            self.send_header("Content-type", "text/json")
-            self.end_headers()
-            self.wfile.write(bytes("OSC Path not found", 'utf-8'))
-        else:
-            self.send_response(200)
-            self.send_header("Content-type", "text/json")
-            self.end_headers()
-            self.wfile.write(bytes(str(node.to_json()), 'utf-8'))
+        self._respond(True)
+
+    def _serve_websocket(self) -> None:
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        # Listening connections stay open for as long as the client wants.
+        self.connection.settimeout(None)
+        OSCQueryWebSocket(self.server, self.connection, self.rfile).serve()
+        self.close_connection = True
+
+    def do_HEAD(self) -> None:
+        self._respond(False)
 
     def log_message(self, format, *args):
         pass
-            
+
+
+class KeepAliveOSCQueryHTTPHandler(OSCQueryHTTPHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes, don't let Nagle hold back the body.
+    disable_nagle_algorithm = True
+    # Close idle keep-alive connections so they don't hold on to their threads.
+    timeout = 30
+
+
+def _osc_string(s):
+    data = s.encode() + b"\0"
+    return data + b"\0" * (-len(data) % 4)
+
+
+def encode_osc_message(address, values):
+    """ Encodes an OSC message with int, float, bool and str arguments. """
+    tags = ","
+    args = b""
+    for v in values:
+        if isinstance(v, bool):
+            tags += "T" if v else "F"
+        elif isinstance(v, int):
+            tags += "i"
+            args += struct.pack(">i", v)
+        elif isinstance(v, float):
+            tags += "f"
+            args += struct.pack(">f", v)
+        elif isinstance(v, str):
+            tags += "s"
+            args += _osc_string(v)
+        else:
+            raise Exception(f"Cannot encode {type(v)} as OSC argument!")
+    return _osc_string(address) + _osc_string(tags) + args
+
+
+if __name__ == "__main__":
+    # Load test: concurrent clients querying the root node, against the sequential
+    # HTTP/1.0 server (new connection per request) and the threaded keep-alive server.
+    import http.client
+    from .utility import get_open_tcp_port
+
+    clients = 8
+    requests_per_client = 500
+
+    root = OSCQueryNode("/", description="root node")
+    for i in range(100):
+        root.add_child_node(OSCQueryNode(f"/avatar/parameters/param_{i}", access=OSCAccess.READWRITE_VALUE, value=[0.5], type_=[float]))
+    host_info = OSCHostInfo("LoadTest", {"ACCESS": True, "VALUE": True}, "127.0.0.1", 9001, "UDP")
+
+    def run_client(port, keep_alive, latencies):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        for _ in range(requests_per_client):
+            if not keep_alive:
+                conn = http.client.HTTPConnection("127.0.0.1", port)
+            start = time.perf_counter()
+            conn.request("GET", "/")
+            conn.getresponse().read()
+            latencies.append(time.perf_counter() - start)
+            if not keep_alive:
+                conn.close()
+        conn.close()
+
+    for name, server_cls, handler_cls, keep_alive in (
+            ("sequential HTTP/1.0", OSCQueryHTTPServer, OSCQueryHTTPHandler, False),
+            ("threaded keep-alive", ThreadingOSCQueryHTTPServer, KeepAliveOSCQueryHTTPHandler, True)):
+        port = get_open_tcp_port()
+        server = server_cls(root, host_info, ('127.0.0.1', port), handler_cls)
+        server.request_queue_size = 128
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+
+        latencies = []
+        threads = [threading.Thread(target=run_client, args=(port, keep_alive, latencies)) for _ in range(clients)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+        server.server_close()
+
+        latencies.sort()
+        p99 = latencies[int(len(latencies) * 0.99)]
+        print(f"{name:>20}: {len(latencies) / elapsed:8.0f} req/s, p99 {p99 * 1000:.2f} ms")
+
@@ -1,45 +1,60 @@
 from enum import IntEnum
 import json
+import time
 from json import JSONEncoder
+from json.encoder import encode_basestring_ascii
 
 class OSCNodeEncoder(JSONEncoder):
     def default(self, o):
         if isinstance(o, OSCQueryNode):
             obj_dict = {}
-            for k, v in vars(o).items():
-                if v is None:
-                    continue
-                if k.lower() == "type_":
-                    obj_dict["TYPE"] = Python_Type_List_to_OSC_Type(v)
-                if k == "contents":
-                    obj_dict["CONTENTS"] = {}
-                    for subNode in v:
-                        if subNode.full_path is not None:
-                            obj_dict["CONTENTS"][subNode.full_path.split("/")[-1]] = subNode
-                        else:
-                            continue
-                else:
-                    obj_dict[k.upper()] = v
-
-            # FIXME: I missed something, so here's a hack!
-
-            if "TYPE_" in obj_dict:
-                del obj_dict["TYPE_"]
+            if o.contents is not None:
+                obj_dict["CONTENTS"] = {name: subNode for name, subNode in o.contents.items() if subNode.full_path is not None}
+            for key, attr in _NODE_FIELDS:
+                v = getattr(o, attr)
+                if v is not None:
+                    obj_dict[key] = v
             return obj_dict
 
         if isinstance(o, type):
             return Python_Type_List_to_OSC_Type([o])
 
         if isinstance(o, OSCHostInfo):
-            obj_dict = {}
-            for k, v in vars(o).items():
-                if v is None:
-                    continue
-                obj_dict[k.upper()] = v
-            return obj_dict
+            return o.to_dict()
         
         return json.JSONEncoder.default(self, o)
 
+# Fallback for values _encode_scalar() does not handle.
+_encoder = OSCNodeEncoder()
+
+def _encode_scalar(v) -> str:
+    """ Encodes a single JSON value the way json.dumps() does, without building an encoder. """
+    t = type(v)
+    if t is float and v - v == 0.0:
+        return float.__repr__(v)
+    if t is str:
+        return encode_basestring_ascii(v)
+    if t is bool:
+        return "true" if v else "false"
+    if isinstance(v, int):
+        return int.__repr__(v)
+    return _encoder.encode(v)
+
+def _encode_list(values) -> str:
+    if type(values) is not list:
+        return _encoder.encode(values)
+    return "[" + ", ".join([_encode_scalar(v) for v in values]) + "]"
+
+# JSON key and attribute of every node field, in the order they are written.
+_NODE_FIELDS = (
+    ("FULL_PATH", "full_path"),
+    ("ACCESS", "access"),
+    ("TYPE", "_type_string"),
+    ("VALUE", "value"),
+    ("DESCRIPTION", "description"),
+    ("HOST_INFO", "host_info"),
+)
+
 class OSCAccess(IntEnum):
     NO_VALUE = 0
     READONLY_VALUE = 1
@@ -47,31 +62,82 @@ class OSCAccess(IntEnum):
     READWRITE_VALUE = 3
 
 class OSCQueryNode():
+    __slots__ = ("contents", "full_path", "access", "type_", "value", "description", "host_info",
+                 "_type_string", "_json", "_parent", "_index")
+
     def __init__(self, full_path=None, contents=None, type_=None, access=None, description=None, value=None, host_info=None):
-        self.contents = contents
-        self.full_path = full_path
-        self.access = access
-        self.type_ = type_
+        # A new node has no cached JSON and no parent yet, so the fields are set
+        # without the invalidation in __setattr__.
+        init = object.__setattr__
+        # Encoded JSON of this subtree, dropped whenever it or a descendant changes
+        init(self, "_json", None)
+        init(self, "_parent", None)
+        # full_path -> node for the whole tree, only kept on the root node
+        init(self, "_index", None)
+        # Children are keyed by the last segment of their full path.
+        if isinstance(contents, list):
+            contents = {node_name(child.full_path): child for child in contents}
+        init(self, "contents", contents)
+        init(self, "full_path", full_path)
+        init(self, "access", access)
+        init(self, "type_", type_)
+        init(self, "_type_string", None if type_ is None else Python_Type_List_to_OSC_Type(type_))
         # Value is always an array!
-        self.value = value
-        self.description = description
-        self.host_info = host_info
+        init(self, "value", value)
+        init(self, "description", description)
+        init(self, "host_info", host_info)
+        if contents is not None:
+            for child in contents.values():
+                child._parent = self
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name[0] != "_":
+            if name == "type_":
+                # The OSC type string is only built when the types change, not on every encode.
+                object.__setattr__(self, "_type_string", None if value is None else Python_Type_List_to_OSC_Type(value))
+            # A node that is neither encoded nor in a tree has nothing to invalidate.
+            if self._json is not None or self._parent is not None:
+                self._invalidate()
+
+    def _invalidate(self):
+        """ Drops the cached JSON of this node and all of its ancestors. """
+        clear = object.__setattr__
+        node = self
+        while node is not None:
+            clear(node, "_json", None)
+            node = node._parent
+            # Encoding a node caches the children it includes, so above an ancestor
+            # without cached JSON nothing is cached either, unless it was left out.
+            if node is not None and node._json is None and node.full_path is not None:
+                break
 
+    def _root(self):
+        node = self
+        while node._parent is not None:
+            node = node._parent
+        return node
+
+    def _get_index(self):
+        root = self._root()
+        if root._index is None:
+            root._index = {}
+            for node in root:
+                if node.full_path is not None:
+                    root._index[node.full_path] = node
+        return root._index
 
     def find_subnode(self, full_path):
         if self.full_path == full_path:
             return self
 
-        foundNode = None
-        if self.contents is None:
-            return None
-        
-        for subNode in self.contents:
-            foundNode = subNode.find_subnode(full_path)
-            if foundNode is not None:
-                break
+        node = self._get_index().get(full_path)
+        if node is None or self._parent is None:
+            return node
 
-        return foundNode
+        # Only return nodes below this one.
+        prefix = self.full_path.rstrip("/") + "/"
+        return node if full_path.startswith(prefix) else None
 
     def add_child_node(self, child):
         if child == self:
@@ -91,27 +157,100 @@ class OSCQueryNode():
         if parent is None:
             parent = OSCQueryNode(parent_path)
             self.add_child_node(parent)
-            
-        
+
+        name = path_split[1]
+        existing = parent.contents.get(name) if parent.contents is not None else None
+        if existing is not None:
+            # Keep the children of a node that was created as an intermediate parent.
+            if existing.contents:
+                if child.contents is None:
+                    child.contents = {}
+                for sub_name, subNode in existing.contents.items():
+                    child.contents.setdefault(sub_name, subNode)
+            parent.remove_child_node(existing)
         if parent.contents is None:
-            parent.contents = []
-        parent.contents.append(child)
+            parent.contents = {}
+        parent.contents[name] = child
+        child._parent = parent
+        parent._invalidate()
+
+        index = self._get_index()
+        for node in child:
+            if node.contents is not None:
+                for subNode in node.contents.values():
+                    subNode._parent = node
+            if node.full_path is not None:
+                index[node.full_path] = node
+
+    def remove_child_node(self, child):
+        """ Removes a node (or the node at a full path) and its children from the tree. """
+        if isinstance(child, str):
+            child = self.find_subnode(child)
+        if child is None or child._parent is None:
+            return None
+
+        parent = child._parent
+        name = node_name(child.full_path)
+        if parent.contents is not None and parent.contents.get(name) is child:
+            del parent.contents[name]
+            if not parent.contents:
+                parent.contents = None
+            parent._invalidate()
+
+        index = self._get_index()
+        for node in child:
+            if index.get(node.full_path) is node:
+                del index[node.full_path]
+        child._parent = None
+        return child
+
 
-    
     def to_json(self):
-        return json.dumps(self, cls=OSCNodeEncoder)
+        return self.to_json_bytes().decode()
+
+    def to_json_bytes(self):
+        """
+        Returns the encoded JSON of this node and its children.
+
+        The result is cached per node and spliced together from the children's
+        cached bytes, so after a change only the changed node and its ancestors
+        are encoded again. Values have to be assigned (node.value = [...]),
+        changing the value list in place does not drop the cache.
+        """
+        if self._json is None:
+            parts = []
+            if self.contents is not None:
+                children = b", ".join(encode_basestring_ascii(name).encode() + b": " + subNode.to_json_bytes()
+                                      for name, subNode in self.contents.items() if subNode.full_path is not None)
+                parts.append(b'"CONTENTS": {' + children + b"}")
+            if self.full_path is not None:
+                parts.append(b'"FULL_PATH": ' + encode_basestring_ascii(self.full_path).encode())
+            if self.access is not None:
+                parts.append(b'"ACCESS": ' + _encode_scalar(self.access).encode())
+            if self._type_string is not None:
+                parts.append(b'"TYPE": ' + encode_basestring_ascii(self._type_string).encode())
+            if self.value is not None:
+                parts.append(b'"VALUE": ' + _encode_list(self.value).encode())
+            if self.description is not None:
+                parts.append(b'"DESCRIPTION": ' + encode_basestring_ascii(self.description).encode())
+            if self.host_info is not None:
+                parts.append(b'"HOST_INFO": ' + self.host_info.to_json().encode())
+            self._json = b"{" + b", ".join(parts) + b"}"
+        return self._json
 
 
     def __iter__(self):
-            yield self
-            if self.contents is not None:
-                for subNode in self.contents:
-                    yield from subNode
+        yield self
+        if self.contents is not None:
+            for subNode in self.contents.values():
+                yield from subNode
 
     def __str__(self) -> str:
         return f'<OSCQueryNode @ {self.full_path} (D: "{self.description}" T:{self.type_} V:{self.value})>'
 
 class OSCHostInfo():
+    __slots__ = ("name", "osc_ip", "osc_port", "osc_transport", "ws_ip", "ws_port", "extensions")
+
     def __init__(self, name, extensions, osc_ip=None, osc_port=None, osc_transport=None, ws_ip=None, ws_port=None) -> None:
         self.name = name
         self.osc_ip = osc_ip
@@ -121,11 +260,23 @@ class OSCHostInfo():
         self.ws_port = ws_port
         self.extensions = extensions
 
+    def to_dict(self) -> dict:
+        obj_dict = {}
+        for k in self.__slots__:
+            v = getattr(self, k)
+            if v is not None:
+                obj_dict[k.upper()] = v
+        return obj_dict
+
     def to_json(self) -> str:
-        return json.dumps(self, cls=OSCNodeEncoder)
+        return json.dumps(self.to_dict())
 
     def __str__(self) -> str:
-        return json.dumps(self, cls=OSCNodeEncoder)
+        return self.to_json()
+
+def node_name(full_path):
+    """ Returns the last segment of a node's full path. """
+    return full_path.rsplit("/", 1)[-1]
 
 def OSC_Type_String_to_Python_Type(typestr):
     types = []
@@ -175,4 +326,48 @@ if __name__ == "__main__":
     #print(root)
 
     for child in root:
-        print(child)
\ No newline at end of file
+        print(child)
+
+    # Benchmark: advertise 10k endpoints, then look each of them up.
+    n = 10_000
+    paths = [f"/avatar/parameters/group_{i // 100}/param_{i}" for i in range(n)]
+    root = OSCQueryNode("/", description="root node")
+    start = time.perf_counter()
+    for path in paths:
+        root.add_child_node(OSCQueryNode(path))
+    inserted = time.perf_counter()
+    for path in paths:
+        assert root.find_subnode(path).full_path == path
+    found = time.perf_counter()
+    print(f"Inserted {n} endpoints in {(inserted - start) * 1000:.1f} ms, "
+          f"looked them up in {(found - inserted) * 1000:.1f} ms "
+          f"({(found - inserted) / n * 1e6:.2f} us/lookup)")
+
+    start = time.perf_counter()
+    root.to_json_bytes()
+    first = time.perf_counter()
+    root.to_json_bytes()
+    cached = time.perf_counter()
+    root.find_subnode(paths[0]).value = [1.0]
+    root.to_json_bytes()
+    changed = time.perf_counter()
+    print(f"Encoded the root in {(first - start) * 1000:.1f} ms, "
+          f"{(cached - first) * 1e6:.1f} us when cached, "
+          f"{(changed - cached) * 1000:.2f} ms after changing one value")
+
+    # Memory per node and cold encode throughput for 100k typed endpoints with a value.
+    import tracemalloc
+    n = 100_000
+    tracemalloc.start()
+    nodes = [OSCQueryNode(f"/avatar/parameters/p{i}", access=OSCAccess.READWRITE_VALUE, type_=[float], value=[0.5]) for i in range(n)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del nodes
+    root = OSCQueryNode("/", description="root node")
+    for i in range(n):
+        root.add_child_node(OSCQueryNode(f"/avatar/parameters/group_{i // 100}/param_{i}", access=OSCAccess.READWRITE_VALUE, type_=[float], value=[0.5]))
+    start = time.perf_counter()
+    encoded = root.to_json_bytes()
+    elapsed = time.perf_counter() - start
+    print(f"{size / n:.0f} bytes per node, encoded {n} endpoints in {elapsed * 1000:.0f} ms "
+          f"({n / elapsed:,.0f} nodes/s, {len(encoded) / elapsed / 1e6:.1f} MB/s)")
\ No newline at end of file
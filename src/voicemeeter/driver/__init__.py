@@ -0,0 +1,33 @@
+import os
+from os import path
+
+from ..errors import VMRError
+
+vm_base = path.join(path.expandvars('%ProgramFiles(x86)%'), 'VB', 'Voicemeeter')
+
+def vm_subpath(*fragments):
+  """ Returns a path based from Voicemeeter's install directory. """
+  return path.join(vm_base, *fragments)
+
+_backends = {}
+
+def get_backend(kind_id):
+  """
+  Returns the default backend for a Voicemeeter kind.
+
+  A backend is any object exposing the VBVMR_* functions of the remote API.
+  The backend is chosen by the VMR_BACKEND environment variable: 'dll'
+  (default) loads VoicemeeterRemote64.dll, 'fake' uses a simulated Voicemeeter.
+  """
+  name = os.environ.get('VMR_BACKEND', 'dll')
+  key = 'dll' if name == 'dll' else (name, kind_id)
+  if key not in _backends:
+    if name == 'dll':
+      from .dll import load
+      _backends[key] = load()
+    elif name == 'fake':
+      from .fake import FakeVoicemeeter
+      _backends[key] = FakeVoicemeeter(kind_id, latency=float(os.environ.get('VMR_FAKE_LATENCY', 0)))
+    else:
+      raise VMRError(f'Unknown Voicemeeter backend: {name}')
+  return _backends[key]
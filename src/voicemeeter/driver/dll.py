@@ -0,0 +1,21 @@
+from os import path
+import sys
+import platform
+import ctypes
+
+from ..errors import VMRError
+from . import vm_subpath
+
+DLL_NAME = 'VoicemeeterRemote64.dll'
+
+def load():
+  """ Loads VoicemeeterRemote64.dll from Voicemeeter's install directory. """
+  bits = 64 if sys.maxsize > 2**32 else 32
+  if platform.system() != 'Windows' or bits != 64:
+    raise VMRError('The vmr package only supports Windows 64-bit')
+
+  dll_path = vm_subpath(DLL_NAME)
+  if not path.exists(dll_path):
+    raise VMRError(f'Could not find {DLL_NAME}')
+
+  return ctypes.cdll.LoadLibrary(dll_path)
@@ -0,0 +1,186 @@
+import time
+from collections import Counter
+
+from .. import kinds
+
+_type_ids = {'basic': 1, 'banana': 2, 'potato': 3}
+
+def _make_parameter_table(kind):
+  """ Creates the parameter table of a kind, keyed by lower-case parameter name. """
+  num_A, num_B = kind.layout
+  params = {}
+  for i in range(num_A + num_B):
+    strip = f'strip[{i}]'
+    params.update({
+      f'{strip}.gain': 0.0,
+      f'{strip}.solo': 0.0,
+      f'{strip}.mute': 0.0,
+      f'{strip}.comp': 0.0,
+      f'{strip}.gate': 0.0,
+      f'{strip}.limit': 0.0,
+      f'{strip}.eqgain1': 0.0,
+      f'{strip}.eqgain2': 0.0,
+      f'{strip}.eqgain3': 0.0,
+      f'{strip}.mono' if i < num_A else f'{strip}.mc': 0.0,
+      **{f'{strip}.a{j}': 0.0 for j in range(1, num_A+1)},
+      **{f'{strip}.b{j}': 0.0 for j in range(1, num_B+1)},
+      f'{strip}.label': '',
+      f'{strip}.device.name': '',
+      f'{strip}.device.sr': '',
+    })
+  for i in range(num_A + num_B):
+    params.update({
+      f'bus[{i}].gain': 0.0,
+      f'bus[{i}].mute': 0.0,
+    })
+  return params
+
+def _key(param):
+  if isinstance(param, bytes):
+    param = param.decode('ascii')
+  return param.strip().lower()
+
+def _value(arg):
+  """ Unwraps a ctypes argument (value or byref) into a Python value. """
+  arg = getattr(arg, '_obj', arg)
+  return getattr(arg, 'value', arg)
+
+class FakeVoicemeeter(object):
+  """
+  A simulated Voicemeeter that stands in for VoicemeeterRemote64.dll.
+
+  Exposes the VBVMR_* functions used by VMRemote, keeps a parameter table
+  for the kind's strip layout and a dirty flag, and sleeps for `latency`
+  seconds on every call. Calls are counted per function in `calls`.
+  """
+  def __init__(self, kind_id='potato', latency=0.0):
+    self.kind = kinds.get(kind_id)
+    self.latency = latency
+    self.params = _make_parameter_table(self.kind)
+    self.dirty = False
+    self.logged_in = False
+    self.calls = Counter()
+
+  def _enter(self, fn_name):
+    self.calls[fn_name] += 1
+    if self.latency:
+      time.sleep(self.latency)
+
+  def _write(self, param, val):
+    key = _key(param)
+    if key.startswith('command.'):
+      return 0
+    if key not in self.params:
+      return -3
+    self.params[key] = val if isinstance(val, str) else float(val)
+    self.dirty = True
+    return 0
+
+  def simulate_ui_change(self, param, val):
+    """ Changes a parameter as if it was moved in Voicemeeter's UI. """
+    self._write(param, val)
+
+  def VBVMR_Login(self):
+    self._enter('Login')
+    self.logged_in = True
+    return 0
+
+  def VBVMR_Logout(self):
+    self._enter('Logout')
+    self.logged_in = False
+    return 0
+
+  def VBVMR_GetVoicemeeterType(self, buf):
+    self._enter('GetVoicemeeterType')
+    getattr(buf, '_obj', buf).value = _type_ids[self.kind.id]
+    return 0
+
+  def VBVMR_GetVoicemeeterVersion(self, buf):
+    self._enter('GetVoicemeeterVersion')
+    getattr(buf, '_obj', buf).value = (_type_ids[self.kind.id] << 24) | (1 << 8)
+    return 0
+
+  def VBVMR_IsParametersDirty(self):
+    self._enter('IsParametersDirty')
+    dirty, self.dirty = self.dirty, False
+    return 1 if dirty else 0
+
+  def VBVMR_GetParameterFloat(self, param, buf):
+    self._enter('GetParameterFloat')
+    val = self.params.get(_key(param))
+    if val is None:
+      return -3
+    if isinstance(val, str):
+      return -5
+    getattr(buf, '_obj', buf).value = val
+    return 0
+
+  def VBVMR_GetParameterStringW(self, param, buf):
+    self._enter('GetParameterStringW')
+    val = self.params.get(_key(param))
+    if val is None:
+      return -3
+    getattr(buf, '_obj', buf).value = str(val)
+    return 0
+
+  def VBVMR_SetParameterFloat(self, param, val):
+    self._enter('SetParameterFloat')
+    return self._write(param, float(_value(val)))
+
+  def VBVMR_SetParameterStringW(self, param, val):
+    self._enter('SetParameterStringW')
+    return self._write(param, str(_value(val)))
+
+  def _run_script(self, script):
+    """ Runs a script of `name=value` statements. Returns the failing line or 0. """
+    if isinstance(script, bytes):
+      script = script.decode('ascii')
+    statements = [s for s in script.replace('\n', ';').replace(',', ';').split(';') if s.strip()]
+    for line, statement in enumerate(statements, 1):
+      param, sep, val = statement.partition('=')
+      if not sep:
+        return line
+      val = val.strip()
+      if val.startswith('"'):
+        val = val.strip('"')
+      else:
+        try:
+          val = float(val)
+        except ValueError:
+          return line
+      if self._write(param, val) != 0:
+        return line
+    return 0
+
+  def VBVMR_SetParameters(self, script):
+    self._enter('SetParameters')
+    return self._run_script(_value(script))
+
+  def VBVMR_SetParametersW(self, script):
+    self._enter('SetParametersW')
+    return self._run_script(_value(script))
+
+
+if __name__ == '__main__':
+  # Benchmark with the default call delay: applying the built-in profiles,
+  # counting the calls and parameter writes that reach the fake Voicemeeter.
+  import sys
+  from ..remote import connect
+  kind_id = sys.argv[1] if len(sys.argv) > 1 else 'potato'
+  fake = FakeVoicemeeter(kind_id)
+  vmr = connect(kind_id, backend=fake)
+  vmr.login()
+  writes = []
+  write = fake._write
+  fake._write = lambda param, val: writes.append(param) or write(param, val)
+
+  for start, name, diff in (('blank', 'base', False), ('blank', 'base', True), ('base', 'base', False), ('base', 'base', True)):
+    vmr.apply_profile(start, diff=False)
+    vmr.clear_cache()
+    writes.clear()
+    calls = sum(fake.calls.values())
+    t = time.perf_counter()
+    vmr.apply_profile(name, diff=diff)
+    elapsed = time.perf_counter() - t
+    print(f"{start:>5} -> {name:<5} {'diff' if diff else 'full':>4}: {elapsed * 1e3:7.1f} ms, "
+          f"{sum(fake.calls.values()) - calls:4} calls, {len(writes):4} parameters written")
@@ -1,10 +1,17 @@
 import os
-import toml
+from collections.abc import Mapping
 from . import kinds
 from .errors import VMRError
 from .util import project_path, merge_dicts
 
-profiles = {}
+# kind id -> {'blank': ..., 'base': ...}, built on first use
+_builtins = {}
+# folder -> (mtime, {name: path}) of the TOML files in profiles/<kind_id>/
+_folders = {}
+# path -> (mtime, config or None if invalid)
+_parsed = {}
+# (kind id, name) -> (versions of the extends chain, resolved profile)
+_resolved = {}
 
 def _make_blank_profile(kind):
   num_A, num_B = kind.layout
@@ -35,26 +42,95 @@ def _make_base_profile(kind):
   abc = merge_dicts(blank, overrides)
   return abc
 
-for kind in kinds.all:
-  profiles[kind.id] = {
-    'blank': _make_blank_profile(kind),
-    'base': _make_base_profile(kind)
-  }
+def _get_builtins(kind):
+  builtins = _builtins.get(kind.id)
+  if builtins is None:
+    builtins = _builtins[kind.id] = {
+      'blank': _make_blank_profile(kind),
+      'base': _make_base_profile(kind)
+    }
+  return builtins
+
+def _get_files(kind):
+  """ Returns {name: path} of the profiles in profiles/<kind_id>/<profile>.toml, listed again when the folder changed. """
+  folder = project_path('profiles', kind.id)
+  try:
+    mtime = os.stat(folder).st_mtime_ns
+  except OSError:
+    return {}
+  cached = _folders.get(folder)
+  if cached is None or cached[0] != mtime:
+    files = {f[:-5]: os.path.join(folder, f) for f in os.listdir(folder) if f.endswith('.toml')}
+    cached = _folders[folder] = (mtime, files)
+  return cached[1]
+
+def _parse(kind, name, path):
+  """ Returns (mtime, config) of a TOML profile, parsed again only when the file changed. """
+  mtime = os.stat(path).st_mtime_ns
+  cached = _parsed.get(path)
+  if cached is None or cached[0] != mtime:
+    import toml
+    try:
+      config = toml.load(path)
+      print(f'Loaded profile {kind.id}/{name}')
+    except toml.TomlDecodeError:
+      print(f'Invalid TOML profile: {kind.id}/{name}.toml')
+      config = None
+    cached = _parsed[path] = (mtime, config)
+  return cached
+
+def _get_raw(kind, name):
+  """ Returns (version, config) of a profile as written, without its extends merged in. Raises KeyError. """
+  path = _get_files(kind).get(name)
+  if path is not None:
+    try:
+      mtime, config = _parse(kind, name, path)
+    except OSError:
+      config = None
+    if config is not None:
+      return (path, mtime), config
+  return name, _get_builtins(kind)[name]
+
+def resolve(kind_id, name):
+  """
+  Returns a profile with its whole `extends` chain merged in. Raises KeyError for unknown profiles.
+
+  Resolved profiles are cached until one of the files in the chain changes,
+  they must not be modified.
+  """
+  kind = kinds.get(kind_id)
+  names = []
+  versions = []
+  chain = []
+  current = name
+  while current is not None:
+    if current in names:
+      raise VMRError(f'Profile {kind.id}/{name} extends itself')
+    version, config = _get_raw(kind, current)
+    names.append(current)
+    versions.append(version)
+    chain.append(config)
+    current = config.get('extends')
+  versions = tuple(versions)
+
+  cached = _resolved.get((kind.id, name))
+  if cached is not None and cached[0] == versions:
+    return cached[1]
+  profile = merge_dicts(*reversed(chain))
+  profile.pop('extends', None)
+  _resolved[(kind.id, name)] = (versions, profile)
+  return profile
+
+class KindProfiles(Mapping):
+  """ The profiles of a kind as written, looked up lazily. """
+  def __init__(self, kind_id):
+    self.kind = kinds.get(kind_id)
+
+  def __getitem__(self, name):
+    return _get_raw(self.kind, name)[1]
+
+  def __iter__(self):
+    return iter({**_get_builtins(self.kind), **_get_files(self.kind)})
 
-# Load profiles from config files in profiles/<kind_id>/<profile>.toml
-if os.path.exists(project_path('profiles')):
-  for kind in kinds.all:
-    profile_folder = project_path('profiles', kind.id)
-    if os.path.exists(profile_folder):
-      filenames = [f for f in os.listdir(profile_folder) if f.endswith('.toml')]
-      configs = {}
-      for filename in filenames:
-        name = filename[:-5] # strip of .toml extension
-        try:
-          configs[name] = toml.load(project_path('profiles', kind.id, filename))
-        except toml.TomlDecodeError:
-          print(f'Invalid TOML profile: {kind.id}/{filename}')
-      
-      for name, cfg in configs.items():
-        print(f'Loaded profile {kind.id}/{name}')
-        profiles[kind.id][name] = cfg
\ No newline at end of file
+  def __len__(self):
+    return len({**_get_builtins(self.kind), **_get_files(self.kind)})
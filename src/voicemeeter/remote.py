@@ -1,14 +1,15 @@
 import ctypes as ct
 import time
 import abc
+import threading
+from contextlib import contextmanager
 
-from .driver import dll
+from . import driver
 from .errors import VMRError, VMRDriverError
 from .input import InputStrip
 from .output import OutputBus
 from . import kinds
 from . import profiles
-from .util import merge_dicts
 
 loggedIn = False
 
@@ -16,11 +17,20 @@ loggedIn = False
 class VMRemote(abc.ABC):
     """ Wrapper around Voicemeeter Remote's C API. """
 
-    def __init__(self, delay=.015):
+    def __init__(self, delay=.015, cache_interval=.1, backend=None):
+        self.backend = backend
         self.delay = delay
         self.cache = {}
-
-    def _call(self, fn, *args, check=True, expected=(0,)):
+        self.cache_interval = cache_interval
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.dirty_count = 0
+        self._cache_checked = None
+        self._pending = {}
+        self._batch_depth = 0
+        self._batch_lock = threading.RLock()
+
+    def _call(self, fn, *args, check=True, expected=(0,), delay=True):
         """
     Runs a C API function.
 
@@ -28,10 +38,11 @@ class VMRemote(abc.ABC):
     function's return value is not 0 (OK).
     """
         fn_name = 'VBVMR_' + fn
-        retval = getattr(dll, fn_name)(*args)
+        retval = getattr(self.backend, fn_name)(*args)
         if check and retval not in expected:
             raise VMRDriverError(fn_name, retval)
-        time.sleep(self.delay)
+        if delay:
+            time.sleep(self.delay)
         return retval
 
     def _login(self):
@@ -85,15 +96,37 @@ class VMRemote(abc.ABC):
     def dirty(self):
         """ True iff UI parameters have been updated. """
         val = self._call('IsParametersDirty', expected=(0, 1))
+        self._cache_checked = time.monotonic()
+        if val == 1:
+            # The flag is cleared by reading it, so the cache has to be dropped here.
+            self.cache.clear()
+            self.dirty_count += 1
         return (val == 1)
 
+    def clear_cache(self):
+        """ Drops all cached parameters and resets the hit/miss counters. """
+        self.cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache_checked = None
+
+    def _refresh_cache(self):
+        """ Checks the dirty flag at most once per cache_interval. """
+        checked = self._cache_checked
+        if checked is None or time.monotonic() - checked >= self.cache_interval:
+            self.dirty
+
     def get(self, param, string=False):
         """ Retrieves a parameter. """
+        with self._batch_lock:
+            if param in self._pending:
+                return self._pending[param]
         param = param.encode('ascii')
-        if not self.dirty:
-            if param in self.cache:
-                pass
-                # return self.cache[param]
+        self._refresh_cache()
+        if param in self.cache:
+            self.cache_hits += 1
+            return self.cache[param]
+        self.cache_misses += 1
 
         if string:
             buf = (ct.c_wchar * 512)()
@@ -105,15 +138,83 @@ class VMRemote(abc.ABC):
         self.cache[param] = val
         return val
 
+    def snapshot(self, params):
+        """
+    Reads (param, string) pairs into the cache in one pass.
+
+    The dirty flag is checked first, so the cache is current.
+    Parameters that are cached or pending in a batch are not read again,
+    the others are read back to back without the delay between calls.
+    """
+        self.dirty
+        for param, string in params:
+            with self._batch_lock:
+                if param in self._pending:
+                    continue
+            param = param.encode('ascii')
+            if param in self.cache:
+                continue
+            if string:
+                buf = (ct.c_wchar * 512)()
+                self._call('GetParameterStringW', param, ct.byref(buf), delay=False)
+            else:
+                buf = ct.c_float()
+                self._call('GetParameterFloat', param, ct.byref(buf), delay=False)
+            self.cache[param] = buf.value
+
     def set(self, param, val):
         """ Updates a parameter. """
+        if isinstance(val, str) and len(val) >= 512:
+            raise VMRError('String is too long')
+        with self._batch_lock:
+            if self._batch_depth > 0:
+                # Only the latest value per parameter is kept until flush().
+                self._pending[param] = val
+                return
         param = param.encode('ascii')
         if isinstance(val, str):
-            if len(val) >= 512:
-                raise VMRError('String is too long')
             self._call('SetParameterStringW', param, ct.c_wchar_p(val))
         else:
             self._call('SetParameterFloat', param, ct.c_float(float(val)))
+        self._invalidate(param)
+
+    def _invalidate(self, *params):
+        """ Drops written parameters and forces a dirty check on the next read. """
+        for param in params:
+            self.cache.pop(param, None)
+        self._cache_checked = None
+
+    @contextmanager
+    def batch(self):
+        """
+    Collects all set() calls made inside the block and writes
+    them with a single flush() when the outermost block exits.
+    """
+        with self._batch_lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._batch_lock:
+                self._batch_depth -= 1
+                done = (self._batch_depth == 0)
+            if done:
+                self.flush()
+
+    def flush(self):
+        """
+    Writes all pending parameters as one Voicemeeter script.
+
+    Returns the number of parameters that were written.
+    """
+        with self._batch_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        script = ';'.join(f'{param}={_format_script_value(val)}' for param, val in pending.items())
+        self._call('SetParametersW', ct.c_wchar_p(script))
+        self._invalidate(*(param.encode('ascii') for param in pending))
+        return len(pending)
 
     def show(self):
         """ Shows Voicemeeter if it's hidden. """
@@ -131,29 +232,37 @@ class VMRemote(abc.ABC):
         """ Loads a preset saved by Voicemeeter. """
         self.set('Command.Load', preset)
 
-    def apply(self, mapping):
-        """ Sets all parameters of a dict. """
-        for key, submapping in mapping.items():
-            strip, index = key.split('-')
-            index = int(index)
-            if strip in ('in', 'input'):
-                target = self.inputs[index]
-            elif strip in ('out', 'output'):
-                target = self.outputs[index]
-            else:
-                raise ValueError(strip)
-            target.apply(submapping)
+    def get_element(self, key):
+        """ Returns the input strip or output bus of a key like in-0 or out-2. """
+        strip, index = key.split('-')
+        index = int(index)
+        if strip in ('in', 'input'):
+            return self.inputs[index]
+        elif strip in ('out', 'output'):
+            return self.outputs[index]
+        else:
+            raise ValueError(strip)
 
-    def apply_profile(self, name):
+    def apply(self, mapping, diff=True):
+        """
+    Sets all parameters of a dict in one batch.
+
+    With diff, the current values of all parameters are read in one
+    snapshot and only the parameters that differ are written.
+    """
+        elements = [(self.get_element(key), submapping) for key, submapping in mapping.items()]
+        with self.batch():
+            if diff:
+                self.snapshot([param for element, submapping in elements for param in element.params(submapping)])
+            for element, submapping in elements:
+                element._apply(submapping, diff)
+
+    def apply_profile(self, name, diff=True):
         try:
-            profile = self.profiles[name]
-            if 'extends' in profile:
-                base = self.profiles[profile['extends']]
-                profile = merge_dicts(base, profile)
-                del profile['extends']
-            self.apply(profile)
+            profile = profiles.resolve(self.kind.id, name)
         except KeyError:
             raise VMRError(f'Unknown profile: {self.kind.id}/{name}')
+        self.apply(profile, diff=diff)
 
     def reset(self):
         self.apply_profile('base')
@@ -166,6 +275,13 @@ class VMRemote(abc.ABC):
         self.logout()
 
 
+def _format_script_value(val):
+    """ Formats a value for use in a Voicemeeter script. """
+    if isinstance(val, str):
+        return '"' + val.replace('"', '') + '"'
+    return repr(float(val))
+
+
 def _make_remote(kind):
     """
   Creates a new remote class and sets its number of inputs
@@ -177,12 +293,16 @@ def _make_remote(kind):
     def init(self, *args, **kwargs):
         VMRemote.__init__(self, *args, **kwargs)
         self.kind = kind
+        if self.backend is None:
+            self.backend = driver.get_backend(kind.id)
         self.num_A, self.num_B = kind.layout
         self.inputs = tuple(InputStrip.make((i < self.num_A), self, i) for i in range(self.num_A + self.num_B))
         self.outputs = tuple(OutputBus.make((i < self.num_B), self, i) for i in range(self.num_A + self.num_B))
 
+    kind_profiles = profiles.KindProfiles(kind.id)
+
     def get_profiles(self):
-        return profiles.profiles[kind.id]
+        return kind_profiles
 
     return type(f'VMRemote{kind.name}', (VMRemote,), {
         '__init__': init,
@@ -193,12 +313,12 @@ def _make_remote(kind):
 _remotes = {kind.id: _make_remote(kind) for kind in kinds.all}
 
 
-def connect(kind_id, delay=None):
+def connect(kind_id, delay=None, **kwargs):
     if delay is None:
         delay = .015
     """ Connect to Voicemeeter and sets its strip layout. """
     try:
         cls = _remotes[kind_id]
-        return cls(delay=delay)
+        return cls(delay=delay, **kwargs)
     except KeyError as err:
-        raise VMRError(f'Invalid Voicemeeter kind: {kind_id}')
\ No newline at end of file
+        raise VMRError(f'Invalid Voicemeeter kind: {kind_id}')
@@ -1,4 +1,5 @@
 import abc
+import math
 from .errors import VMRError
 
 class VMElement(abc.ABC):
@@ -18,21 +19,65 @@ class VMElement(abc.ABC):
   def identifier(self):
     pass
   
-  def apply(self, mapping):
-    """ Sets all parameters of a dict for the strip. """
+  def get_property(self, key):
+    """ Returns the VMProperty of an attribute, without reading it. """
+    prop = getattr(type(self), key, None)
+    if not isinstance(prop, VMProperty):
+      raise VMRError(f'Invalid {self.identifier} attribute: {key}')
+    return prop
+
+  def params(self, mapping):
+    """ Returns (param, string) of every attribute of a dict, for VMRemote.snapshot(). """
+    params = []
+    for key in mapping:
+      prop = self.get_property(key)
+      params.append((f'{self.identifier}.{prop.param}', prop.type is str))
+    return params
+
+  def apply(self, mapping, diff=True):
+    """
+    Sets all parameters of a dict for the strip in one batch.
+
+    With diff, the current values are read in one snapshot and
+    only the parameters that differ are written.
+    """
+    with self._remote.batch():
+      if diff:
+        self._remote.snapshot(self.params(mapping))
+      self._apply(mapping, diff)
+
+  def _apply(self, mapping, diff):
+    """ Sets the parameters of a dict, skipping those that match the cache with diff. """
+    props = {key: self.get_property(key) for key in mapping}
     for key, val in mapping.items():
-      if not hasattr(self, key):
-        raise VMRError(f'Invalid {self.identifier} attribute: {key}')
+      if diff and props[key].equals(getattr(self, key), val):
+        continue
       setattr(self, key, val)
     
 
+class VMProperty(property):
+  """ A property for a VM parameter, which knows the type and range of its values. """
+  def __init__(self, fget, fset, param, type, range=None):
+    super().__init__(fget, fset)
+    self.param = param
+    self.type = type
+    self.range = range
+
+  def equals(self, a, b):
+    """ True iff two values are the same parameter value, floats are stored in single precision. """
+    if self.type is float:
+      return math.isclose(a, b, rel_tol=1e-6, abs_tol=1e-6)
+    if self.type is bool:
+      return bool(a) == bool(b)
+    return a == b
+
 def bool_prop(param):
   """ A boolean VM parameter. """
   def getter(self):
     return (self.get(param) == 1)
   def setter(self, val):
     return self.set(param, 1 if val else 0)
-  return property(getter, setter)
+  return VMProperty(getter, setter, param, bool)
 
 def str_prop(param):
   """ A string VM parameter. """
@@ -40,7 +85,7 @@ def str_prop(param):
     return self.get(param, string=True)
   def setter(self, val):
     return self.set(param, val)
-  return property(getter, setter)
+  return VMProperty(getter, setter, param, str)
 
 def float_prop(param, range=None, normalize=False):
   """ A floating point VM parameter. """
@@ -57,4 +102,4 @@ def float_prop(param, range=None, normalize=False):
       if normalize:
         val = val*(hi-lo)+lo
     return self.set(param, val)
-  return property(getter, setter)
\ No newline at end of file
+  return VMProperty(getter, setter, param, float, (0.0, 1.0) if normalize else range)
\ No newline at end of file
@@ -5,8 +5,8 @@ PROJECT_DIR = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__f
 def project_path(*parts):
   return os.path.join(PROJECT_DIR, *parts)
 
-def merge_dicts(*srcs, dest={}):
-  target = dest
+def merge_dicts(*srcs, dest=None):
+  target = {} if dest is None else dest
   for src in srcs:
     for key, val in src.items():
       if isinstance(val, dict):